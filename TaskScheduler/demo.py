@@ -10,5 +10,7 @@ if __name__ == "__main__":
     task1 = Task("task1", 1, ["20230103_sh600030_order"], "strategy_module", "strategy_func1")
     scheduler.add_task(task1)
 
-    # 执行任务
-    scheduler.execute_tasks()
\ No newline at end of file
+    # 执行任务：需要相同日期数据的任务合并执行，加载下一批数据的同时计算当前批
+    report = scheduler.execute_tasks()
+    for item in report:
+        print(f"{item['task_id']}: {item['status']}, wait {item['wait']}s, compute {item['compute']:.2f}s")
\ No newline at end of file
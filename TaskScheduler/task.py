@@ -6,9 +6,15 @@ class Task:
         self.status = "待执行"
         self.module_name = module_name
         self.func_name = func_name
+        # 由 TaskScheduler.execute_tasks 填写：等待时间（开始执行到开始计算）与计算时间，单位秒
+        self.wait_time = None
+        self.compute_time = None
 
     def start(self):
         self.status = "执行中"
 
     def complete(self):
-        self.status = "已完成"
\ No newline at end of file
+        self.status = "已完成"
+
+    def fail(self):
+        self.status = "失败"
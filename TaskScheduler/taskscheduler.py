@@ -1,99 +1,199 @@
 import importlib
 import multiprocessing
-from multiprocessing import Lock, Manager, Pool
-import psutil
+import threading
+import time
 
 from datablock import DataBlock
 
+# 工作进程中当前批次的数据块，由 _init_worker 在进程启动时设置一次，批内所有任务共用
+_worker_blocks = None
+
+
+def _init_worker(blocks):
+    global _worker_blocks
+    _worker_blocks = blocks
+
+
+def _run_task(task):
+    # 在工作进程中执行，返回 (结果, 异常, 开始计算时间, 结束时间)
+    started = time.time()
+    try:
+        module = importlib.import_module(task.module_name)
+        func = getattr(module, task.func_name)
+        result, error = func(_worker_blocks), None
+    except Exception as e:
+        result, error = None, repr(e)
+    return result, error, started, time.time()
+
+
+def _date(data_block):
+    # data_block 格式: '<date>_<stock>_<table>'
+    return data_block.split('_', 1)[0]
+
+
 class TaskScheduler:
-    def __init__(self, max_memory):
-        self.max_memory = max_memory  # 设置最大内存容量（字节）
-        self.manager = Manager()
-        self.data_cache = self.manager.dict()  # 共享数据缓存
-        self.data_priority_queue = self.manager.list()  # 数据块优先级队列
-        self.task_queue = self.manager.Queue()  # 任务队列
-        self.lock = Lock()  # 锁
-        
+    def __init__(self, max_memory, processes=None):
+        """
+        :param max_memory: 父进程中驻留数据块的总大小上限（字节），包括正在计算的批次和预取的下一批
+        :param processes: 工作进程数，默认为 CPU 核数
+        """
+        self.max_memory = max_memory
+        self.processes = processes or multiprocessing.cpu_count()
+        self.data_cache = {}  # data_block -> DataBlock，ref_count 为尚未完成的任务中需要它的个数
+        self.tasks = []  # 待执行的任务
+        self.lock = threading.Lock()  # 保护 data_cache，预取线程与主线程共用
+        self.failed_blocks = {}  # 加载失败的数据块 -> 异常
 
     def add_task(self, task):
         with self.lock:
             for data_block in task.data_requirements:
-                if data_block in self.data_cache:
-                    self.data_cache[data_block].increase_ref()
-                else:
-                    db = DataBlock(data_block)
-                    db.increase_ref()
-                    self.data_cache[data_block] = db
-                self._update_data_priority(data_block)
-            self.task_queue.put(task)
-
-    def _update_data_priority(self, data_block):
-        # 根据引用计数更新数据块优先级
-        # 优先级为 -ref_count 以实现最高优先级先加载
-        priority = -self.data_cache[data_block].ref_count
-        if data_block not in self.data_priority_queue:
-            self.data_priority_queue.append((priority, data_block))
-
-    def load_data(self, data_block):
-        # 检查内存是否足够
-        current_memory_usage = psutil.Process().memory_info().rss
-        if current_memory_usage + self.data_cache[data_block].size <= self.max_memory:
-            self.data_cache[data_block].load()
-            self.data_cache[data_block].in_memory = True
-        else:
-            # 内存不足，卸载低优先级的数据块
-            self._unload_low_priority_data()
-            self.data_cache[data_block].load()
-            self.data_cache[data_block].in_memory = True
-        db = self.data_cache[data_block]
-        print(f"Data block {data_block} loaded into memory.{db.data.head()}")
-
-    def _unload_low_priority_data(self):
-        # 按优先级卸载低优先级的数据块
-        if self.data_priority_queue:
-            # 找到优先级最低的数据块
-            lowest_priority = max(self.data_priority_queue, key=lambda x: x[0])[0]
-            for db_item in self.data_priority_queue:
-                if db_item[0] == lowest_priority:
-                    db_path = db_item[1]
-                    if self.data_cache[db_path].ref_count == 0:
-                        self.data_cache[db_path].unload()
-                        self.data_cache[db_path].in_memory = False
-                        self.data_priority_queue.remove(db_item)
-                        break
+                if data_block not in self.data_cache:
+                    self.data_cache[data_block] = DataBlock(data_block)
+                self.data_cache[data_block].increase_ref()
+            self.tasks.append(task)
+
+    def _plan_batches(self):
+        """
+        按数据局部性排序并分批：
+        - 需要相同日期（以及相同数据块）的任务相邻，同一天的数据只加载一次
+        - 连续的任务合并为一批，每批所需数据块总大小不超过 max_memory 的一半，
+          使当前批与预取的下一批同时驻留时不超过 max_memory；单个任务超过一半时单独成批
+        :return: [(tasks, data_blocks)]
+        """
+        budget = self.max_memory // 2
+        tasks = sorted(self.tasks, key=lambda task: (
+            sorted({_date(data_block) for data_block in task.data_requirements}),
+            sorted(task.data_requirements),
+            -task.priority,
+        ))
+        batches = []
+        batch, blocks, size = [], set(), 0
+        for task in tasks:
+            new_blocks = set(task.data_requirements) - blocks
+            new_size = sum(self.data_cache[data_block].size for data_block in new_blocks)
+            if batch and size + new_size > budget:
+                batches.append((batch, blocks))
+                batch, blocks, size = [], set(), 0
+                new_blocks = set(task.data_requirements)
+                new_size = sum(self.data_cache[data_block].size for data_block in new_blocks)
+            batch.append(task)
+            blocks |= new_blocks
+            size += new_size
+        if batch:
+            batches.append((batch, blocks))
+        return batches
+
+    def load_data(self, data_blocks):
+        # 已在内存中的数据块直接复用
+        for data_block in sorted(data_blocks):
+            with self.lock:
+                db = self.data_cache[data_block]
+            if db.in_memory:
+                continue
+            try:
+                db.load()
+                print(f"Data block {data_block} loaded into memory.")
+            except Exception as e:
+                print(f"Error loading data block {data_block}: {e}")
+                with self.lock:
+                    self.failed_blocks[data_block] = e
+
+    def _prefetch(self, data_blocks):
+        thread = threading.Thread(target=self.load_data, args=(data_blocks,), daemon=True)
+        thread.start()
+        return thread
+
+    def _unload_except(self, keep):
+        # 卸载下一批不需要的数据块；不再被任何任务需要的数据块同时移出 data_cache
+        with self.lock:
+            for data_block in list(self.data_cache):
+                db = self.data_cache[data_block]
+                if data_block in keep:
+                    continue
+                db.unload()
+                if db.ref_count == 0:
+                    del self.data_cache[data_block]
 
     def execute_tasks(self):
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            while not self.task_queue.empty():
-                task = self.task_queue.get()
-                # 确保所有数据块都已加载
-                for data_block in task.data_requirements:
-                    if not self.data_cache[data_block].in_memory:
-                        self.load_data(data_block)
-                # 执行任务
-
-                pool.apply_async(self._run_task, args=(task,), callback=self._task_callback)
-
-    def _run_task(self, task):
-        task.start()
-        # 动态加载任务函数
-        print('runnning task:', task.task_id)
-        module = importlib.import_module(task.module_name)
-        func = getattr(module, task.func_name)
-        # 执行任务，传入数据缓存
-        result = func(self.data_cache)
-        task.complete()
-        return task, result
-
-    def _task_callback(self, task, result):
-        try:
-            print(f"Task completed with result: {result}")
+        """
+        按批执行全部任务并等待结果：批内任务并行计算，同时在后台线程中预取下一批缺少的数据块，
+        两批都需要的数据块保留在内存中不重复加载
+        :return: 每个任务的 {'task_id', 'status', 'wait', 'compute', 'result', 'error'}，
+                 wait 为从开始执行到该任务开始计算的时间，compute 为计算时间
+        """
+        batches = self._plan_batches()
+        self.tasks = []
+        report = []
+        load_wait = 0.0
+        start = time.time()
+
+        prefetch = self._prefetch(batches[0][1]) if batches else None
+        for i, (tasks, blocks) in enumerate(batches):
+            blocked_at = time.time()
+            prefetch.join()
+            load_wait += time.time() - blocked_at
+            next_blocks = batches[i + 1][1] if i + 1 < len(batches) else set()
+
             with self.lock:
-                for data_block in task.data_requirements:
+                resident = {data_block: self.data_cache[data_block] for data_block in blocks
+                            if data_block not in self.failed_blocks}
+            runnable = []
+            for task in tasks:
+                missing = [data_block for data_block in task.data_requirements if data_block not in resident]
+                if missing:
+                    report.append(self._finish_task(task, None, f"data blocks not loaded: {missing}", None, None, start))
+                else:
+                    runnable.append(task)
+
+            # 显式使用 fork：工作进程直接继承父进程中的数据块（写时复制），
+            # spawn/forkserver（Python 3.14 起 POSIX 的默认方式）会给每个工作进程传一份序列化的副本，超出 max_memory
+            # 先创建工作进程再启动预取线程，避免在有其他线程运行时 fork
+            with multiprocessing.get_context('fork').Pool(
+                    processes=max(1, min(self.processes, len(runnable))),
+                    initializer=_init_worker, initargs=(resident,)) as pool:
+                pending = []
+                for task in runnable:
+                    task.start()
+                    pending.append((task, pool.apply_async(_run_task, args=(task,))))
+                prefetch = self._prefetch(next_blocks - blocks)
+
+                for task, async_result in pending:
+                    try:
+                        result, error, started, finished = async_result.get()
+                    except Exception as e:
+                        # 例如结果无法序列化传回
+                        result, error, started, finished = None, repr(e), None, None
+                    report.append(self._finish_task(task, result, error, started, finished, start))
+
+            prefetch.join()
+            self._unload_except(next_blocks)
+
+        total = time.time() - start
+        compute = sum(item['compute'] for item in report)
+        print(f"{len(report)} tasks in {len(batches)} batches, {total:.1f}s elapsed, "
+              f"{compute:.1f}s compute, {load_wait:.1f}s blocked on data loading")
+        return report
+
+    def _finish_task(self, task, result, error, started, finished, start):
+        if error is None:
+            task.complete()
+        else:
+            task.fail()
+        task.wait_time = (started - start) if started is not None else None
+        task.compute_time = (finished - started) if started is not None else 0.0
+        with self.lock:
+            for data_block in task.data_requirements:
+                if data_block in self.data_cache:
                     self.data_cache[data_block].decrease_ref()
-                    if self.data_cache[data_block].ref_count == 0:
-                        self.data_cache[data_block].unload()
-                        del self.data_cache[data_block]
-        except Exception as e:
-            print(f"Error in callback: {e}")
- 
+        if error is None:
+            print(f"Task {task.task_id} completed with result: {result}")
+        else:
+            print(f"Task {task.task_id} failed: {error}")
+        return {
+            'task_id': task.task_id,
+            'status': task.status,
+            'wait': task.wait_time,
+            'compute': task.compute_time,
+            'result': result,
+            'error': error,
+        }
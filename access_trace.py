@@ -0,0 +1,70 @@
+"""
+访问轨迹的二进制记录与读取，供 cache_simulator 离线回放。
+
+每条记录: 定长头 '<dBIQH'（时间戳, 事件, 客户端 IPv4, 大小, data_id 字节数）+ UTF-8 编码的 data_id
+- REQUEST: size 为请求时该数据的大小（已缓存时为实际大小，否则为预估大小）
+- BATCH:   data_id 为逗号连接的多个 data_id，size 为总大小
+- COMPLETE: size 为 0
+- CANCEL:  客户端放弃等待、撤销之前的 REQUEST，size 为 0
+只记录服务端实际登记的请求（带 max_wait 被拒绝的 REQUEST 不记录）
+"""
+
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+EVENT_REQUEST = 1
+EVENT_COMPLETE = 2
+EVENT_BATCH = 3
+EVENT_CANCEL = 4
+
+_RECORD = struct.Struct('<dBIQH')
+
+TraceEvent = namedtuple('TraceEvent', ['timestamp', 'event', 'client', 'size', 'data_id'])
+
+
+def _client_to_int(client_ip):
+    try:
+        return struct.unpack('!I', socket.inet_aton(client_ip))[0]
+    except OSError:
+        return 0
+
+
+class TraceRecorder:
+    def __init__(self, trace_file, flush_interval=1.0):
+        self.trace_file = trace_file
+        self.flush_interval = flush_interval
+        self._fp = open(trace_file, 'ab')
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def record(self, event, data_id, size=0, client_ip='0.0.0.0'):
+        data = data_id.encode()
+        now = time.time()
+        record = _RECORD.pack(now, event, _client_to_int(client_ip), size, len(data)) + data
+        with self._lock:
+            self._fp.write(record)
+            if now - self._last_flush >= self.flush_interval:
+                self._fp.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+def read_trace(trace_file):
+    """按记录顺序逐条返回 TraceEvent"""
+    with open(trace_file, 'rb') as fp:
+        while True:
+            head = fp.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            timestamp, event, client, size, length = _RECORD.unpack(head)
+            data = fp.read(length)
+            if len(data) < length:
+                # 记录被截断（例如服务被强制终止）
+                return
+            yield TraceEvent(timestamp, event, client, size, data.decode())
@@ -1,10 +1,16 @@
+import os
+import json
 import socket
 import threading
 import sys
 import logging
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 
 from data_cache_new import DataCache
+from cluster import parse_fetch
+from access_trace import TraceRecorder, EVENT_REQUEST, EVENT_COMPLETE, EVENT_BATCH, EVENT_CANCEL
+import shm_utils
 
 logger = logging.getLogger('cache_server_logger')
 logger.setLevel(logging.DEBUG)
@@ -23,14 +29,16 @@ logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
 class CacheServer:
-    def __init__(self, data_cache:DataCache , host='localhost', port=6000, max_workers=10):
+    def __init__(self, data_cache:DataCache , host='localhost', port=6000, max_workers=10, trace_file=None):
         """
         :param data_cache: 一个 DataCache 实例
+        :param trace_file: 记录 REQUEST/BATCH/COMPLETE 访问轨迹的文件，供 cache_simulator 回放；None 不记录
         """
         self.data_cache = data_cache
         self.host = host
         self.port = port
         self.max_workers = max_workers
+        self.tracer = TraceRecorder(trace_file) if trace_file else None
 
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -53,6 +61,8 @@ class CacheServer:
 
     def stop(self):
         logger.info("Stopping CacheServer...")
+        if self.tracer is not None:
+            self.tracer.close()
         self.data_cache.exit_and_clean()
         self.server_socket.close()
 
@@ -66,40 +76,160 @@ class CacheServer:
             return
 
         if data.startswith("REQUEST"):
-            # data 格式: "REQUEST#<data_id>"
-            cmd, data_id = data.split('#', 1)
-            loaded = self.data_cache.request_load(data_id)
-            if loaded:
+            # data 格式: "REQUEST#<data_id>[#<max_wait>]"，带 max_wait 时只接受预计 max_wait 秒内能就绪的请求
+            # 未就绪时返回 "WAIT|<position>|<eta>|<overloaded>"，不接受时返回 "UNAVAILABLE|..."（未登记请求，无需 COMPLETE）
+            parts = data.split('#')
+            data_id = parts[1]
+            max_wait = float(parts[2]) if len(parts) > 2 else None
+            loaded = self.data_cache.request_load(data_id, max_wait)
+            if self.tracer is not None and loaded is not None:
+                # 只记录已登记的请求
+                self.tracer.record(EVENT_REQUEST, data_id, self.data_cache.get_data_size(data_id), addr[0])
+            if loaded is None:
+                wait_info = self.data_cache.get_wait_info(data_id)
+                client_socket.sendall(wait_info.replace("WAIT", "UNAVAILABLE", 1).encode())
+            elif loaded:
                 # 可能已经在缓存，也可能刚开始加载
                 info = self.data_cache.get_cache_info(data_id)
                 if info:
                     # 已经加载完
-                    client_socket.send(info.encode())
+                    client_socket.sendall(info.encode())
                 else:
                     # 正在加载中
-                    client_socket.send("WAIT".encode())
+                    client_socket.sendall(self.data_cache.get_wait_info(data_id).encode())
             else:
                 # 内存不够，排队中
-                client_socket.send("WAIT".encode())
+                client_socket.sendall(self.data_cache.get_wait_info(data_id).encode())
 
         elif data.startswith("CHECK"):
             # data 格式: "CHECK#<data_id>"
             cmd, data_id = data.split('#', 1)
             info = self.data_cache.get_cache_info(data_id)
             if info:
-                client_socket.send(info.encode())
+                client_socket.sendall(info.encode())
+            elif self.data_cache.get_load_error(data_id) is not None:
+                # 加载失败，等待的请求已被释放，无需 COMPLETE
+                client_socket.sendall("INVALID_REQUEST".encode())
             else:
                 # 默认check是非首次请求，也即data_id合法且在等待加载中
-                client_socket.send("WAIT".encode())
+                client_socket.sendall(self.data_cache.get_wait_info(data_id).encode())
+
+        elif data.startswith("CANCEL"):
+            # data 格式: "CANCEL#<data_id>"，客户端放弃等待，撤销之前的 REQUEST
+            cmd, data_id = data.split('#', 1)
+            if self.data_cache.cancel_request(data_id):
+                if self.tracer is not None:
+                    self.tracer.record(EVENT_CANCEL, data_id, 0, addr[0])
+                client_socket.sendall("ACK".encode())
+            else:
+                client_socket.sendall("INVALID_REQUEST".encode())
+
+        elif data.startswith("BATCH_CHECK"):
+            # data 格式: "BATCH_CHECK#<ticket>"
+            cmd, ticket = data.split('#', 1)
+            client_socket.sendall(self.data_cache.check_batch(int(ticket)).encode())
+
+        elif data.startswith("BATCH"):
+            # data 格式: "BATCH#<data_id1>,<data_id2>,..."，整体准入后返回 ADMITTED，否则返回 WAIT#<ticket>
+            cmd, data_ids = data.split('#', 1)
+            if self.tracer is not None:
+                size = sum(self.data_cache.get_data_size(data_id) for data_id in data_ids.split(','))
+                self.tracer.record(EVENT_BATCH, data_ids, size, addr[0])
+            admitted, ticket = self.data_cache.request_batch(data_ids.split(','))
+            if admitted:
+                client_socket.sendall("ADMITTED".encode())
+            else:
+                client_socket.sendall(f"WAIT#{ticket}".encode())
 
         elif data.startswith("COMPLETE"):
             logger.debug('complete notification received')
-            # data 格式: "COMPLETE#<data_id>"
-            cmd, data_id = data.split('#', 1)
-            self.data_cache.on_complete(data_id)
-            client_socket.send("ACK".encode())
+            # data 格式: "COMPLETE#<data_id>[#<shm_name>]"，shm_name 为客户端实际使用的段
+            parts = data.split('#')
+            data_id = parts[1]
+            shm_name = parts[2] if len(parts) > 2 else None
+            if self.tracer is not None:
+                self.tracer.record(EVENT_COMPLETE, data_id, 0, addr[0])
+            self.data_cache.on_complete(data_id, shm_name)
+            client_socket.sendall("ACK".encode())
             logger.debug('ack sent')
+        elif data.startswith("INVALIDATE"):
+            # data 格式: "INVALIDATE#<data_id>"，强制重新加载（例如数据修正后）
+            cmd, data_id = data.split('#', 1)
+            if self.data_cache.invalidate(data_id):
+                client_socket.sendall("ACK".encode())
+            else:
+                client_socket.sendall("INVALID_REQUEST".encode())
+        elif data.startswith("FETCH"):
+            # data 格式: "FETCH#<data_id>[#<start>:<stop>[#<col1,col2>]]"，供远端节点/客户端拉取原始字节
+            data_id, rows, columns = parse_fetch(data)
+            self._handle_fetch(client_socket, data_id, rows, columns)
+
         else:
-            client_socket.send("INVALID_REQUEST".encode())
+            client_socket.sendall("INVALID_REQUEST".encode())
 
         client_socket.close()
+
+    def _handle_fetch(self, client_socket:socket, data_id, rows=None, columns=None):
+        """
+        响应头 'OK|shape|dtype|columns|nbytes|dicts\n' 后紧跟结果的原始字节（C 连续），
+        dicts 为所选列中字典编码列的字典（JSON）
+        - 全部列：所选行在共享内存中是连续的一段，用 os.sendfile 直接从共享内存发送，不经过用户态拷贝
+        - 部分列：行优先存储下列不连续，按行分块收集后发送，限制额外内存
+        调用方应先通过 REQUEST 固定数据，传输结束后再 COMPLETE
+        """
+        segment = self.data_cache.get_segment(data_id)
+        if segment is None:
+            client_socket.sendall("WAIT\n".encode())
+            return
+        shm_name, shape, dtype, all_columns, nbytes, dicts = segment
+
+        n_rows = shape[0] if shape else 0
+        start, stop = (None, None) if rows is None else rows
+        start, stop, _ = slice(start, stop).indices(n_rows)
+        stop = max(start, stop)
+        row_nbytes = nbytes // n_rows if n_rows else 0
+
+        if columns is None or list(columns) == list(all_columns):
+            out_shape = (stop - start,) + tuple(shape[1:])
+            out_columns = all_columns
+            col_idx = None
+        else:
+            try:
+                col_idx = [all_columns.index(col) for col in columns]
+            except ValueError:
+                client_socket.sendall("INVALID_REQUEST\n".encode())
+                return
+            out_shape = (stop - start, len(col_idx))
+            out_columns = list(columns)
+        out_nbytes = int(np.prod(out_shape)) * dtype.itemsize
+
+        out_dicts = {col: values for col, values in dicts.items() if col in out_columns}
+        header = f"OK|{out_shape}|{dtype}|{','.join(out_columns)}|{out_nbytes}|{json.dumps(out_dicts)}\n"
+        client_socket.sendall(header.encode())
+        fd, size = shm_utils.open_segment(shm_name)
+        try:
+            if col_idx is None:
+                self._sendfile(client_socket, fd, start * row_nbytes, out_nbytes)
+            else:
+                self._send_columns(client_socket, fd, size, shape, dtype, start, stop, col_idx)
+        finally:
+            os.close(fd)
+        logger.debug(f"sent {out_nbytes} bytes of {data_id}")
+
+    def _sendfile(self, client_socket:socket, fd, offset, count):
+        while count > 0:
+            sent = os.sendfile(client_socket.fileno(), fd, offset, count)
+            if sent == 0:
+                raise ConnectionError('connection closed during sendfile')
+            offset += sent
+            count -= sent
+
+    def _send_columns(self, client_socket:socket, fd, size, shape, dtype, start, stop, col_idx, chunk_rows=65536):
+        with shm_utils.map_segment(fd, size, advice='sequential') as shm_mmap:
+            shm_arr = np.ndarray(shape, dtype=dtype, buffer=shm_mmap)
+            try:
+                for chunk_start in range(start, stop, chunk_rows):
+                    chunk = np.ascontiguousarray(shm_arr[chunk_start:min(chunk_start + chunk_rows, stop), col_idx])
+                    client_socket.sendall(memoryview(chunk).cast('B'))
+            finally:
+                del shm_arr
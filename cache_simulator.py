@@ -0,0 +1,235 @@
+"""
+离线回放 CacheServer 记录的访问轨迹（见 access_trace），评估不同缓存容量与淘汰策略。
+
+复用 DataCache 的准入与淘汰逻辑（request_load / request_batch / on_complete / _manage_cache，
+以及 PriorityQueue），只把加载替换为按模拟时钟计时的登记，不做任何磁盘或共享内存 IO：
+- 加载：单个后台加载线程按 FIFO 依次加载，耗时 = 数据大小 / 加载吞吐
+- 数据大小：取轨迹中 REQUEST 记录的大小；只出现在 BATCH 中的数据按批量总大小平分
+- COMPLETE：按记录的时间回放；若模拟中数据就绪得更晚，则推迟到就绪时刻（客户端用完才会 COMPLETE）
+- CANCEL：到记录的时间仍未就绪则撤销请求（cancel_request），不计入等待时间；已经就绪则视为在该时刻 COMPLETE
+
+用法:
+    python cache_simulator.py trace.bin --capacity 10 20 40 --eviction all_unused on_demand --throughput 500
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+from collections import defaultdict, deque
+
+import numpy as np
+
+from data_cache_new import DataCache
+from access_trace import read_trace, EVENT_REQUEST, EVENT_COMPLETE, EVENT_BATCH, EVENT_CANCEL
+
+_LOAD_DONE = 0
+_COMPLETE = 1
+_CANCEL = 2
+_TRACE = 3
+
+
+class SimulatedDataCache(DataCache):
+    def __init__(self, sizes, cache_size=20, eviction='all_unused'):
+        """
+        :param sizes: data_id -> 字节数
+        :param cache_size: 缓存容量（GB），同 config 中的 cache_size
+        """
+        # 不取锁文件、不启动加载线程和文件监听
+        self._init_state({'cache_size': cache_size, 'eviction': eviction, 'fingerprint': 'off'})
+        self.sizes = sizes
+        self.bytes_loaded = 0
+        self.n_loads = 0
+
+    def __del__(self):
+        pass
+
+    def _estimate_size(self, data_id):
+        return self.sizes.get(data_id, 0)
+
+    def _actually_load_data(self, data_id):
+        with self._cache_lock:
+            if data_id in self.cache:
+                self.cache_usage -= self._pending_size.pop(data_id, 0)
+                return
+            if not self.cache_order.check_exist(data_id):
+                # 加载前所有请求都已取消
+                return
+            size = self.sizes.get(data_id, 0)
+            self.cache[data_id] = {'shm_name': f'/sim_{data_id}', 'size': size}
+            self.cache_usage += size
+            self.cache_usage -= self._pending_size.pop(data_id, 0)
+            self.bytes_loaded += size
+            self.n_loads += 1
+
+    def _unlink_entry(self, info):
+        pass
+
+
+def load_trace(trace_file):
+    """
+    读取轨迹，返回 (requests, sizes)
+    requests: 按时间排序的 (timestamp, data_ids, is_batch, releases)，
+    releases 与 data_ids 一一对应，为同一客户端对该数据的下一个 COMPLETE/CANCEL：(时间, 是否为 CANCEL)，没有则为 None
+    """
+    events = sorted(read_trace(trace_file), key=lambda event: event.timestamp)
+    sizes = {}
+    requests = []
+    # (client, data_id) -> 尚未配对 COMPLETE/CANCEL 的请求 [(requests 下标, data_ids 中的位置)]
+    open_requests = defaultdict(deque)
+    for event in events:
+        if event.event in (EVENT_COMPLETE, EVENT_CANCEL):
+            pending = open_requests.get((event.client, event.data_id))
+            if pending:
+                i, j = pending.popleft()
+                requests[i][3][j] = (event.timestamp, event.event == EVENT_CANCEL)
+            continue
+        data_ids = event.data_id.split(',') if event.event == EVENT_BATCH else [event.data_id]
+        if event.event == EVENT_REQUEST:
+            if event.size:
+                sizes[event.data_id] = event.size
+        else:
+            share = event.size // len(data_ids)
+            for data_id in data_ids:
+                sizes.setdefault(data_id, share)
+        for j, data_id in enumerate(data_ids):
+            open_requests[(event.client, data_id)].append((len(requests), j))
+        requests.append((event.timestamp, data_ids, event.event == EVENT_BATCH, [None] * len(data_ids)))
+    return requests, sizes
+
+
+def simulate(requests, sizes, cache_size, eviction='all_unused', throughput=500 * 1024**2):
+    """
+    按模拟时钟回放请求
+    :param throughput: 加载吞吐（字节/秒）
+    :return: 统计结果 dict
+    """
+    cache = SimulatedDataCache(sizes, cache_size=cache_size, eviction=eviction)
+    heap = []
+    seq = itertools.count()
+    for timestamp, data_ids, is_batch, releases in requests:
+        heapq.heappush(heap, (timestamp, _TRACE, next(seq), (data_ids, is_batch, releases)))
+
+    loading = None
+    waiting_on = defaultdict(list)  # data_id -> 等待它加载的 waiter
+    batch_waiters = {}  # ticket -> 尚未准入的批量 waiter
+    waits = []
+    n_cancelled = 0
+    n_requests = 0
+    hits = 0
+    peak_usage = 0
+
+    def ready(waiter, now):
+        waiter['ready'] = True
+        waits.append(now - waiter['start'])
+        for data_id, release in zip(waiter['data_ids'], waiter['releases']):
+            if release is None:
+                continue
+            release_time, cancelled = release
+            if cancelled and release_time < now:
+                # 已在 _CANCEL 事件中撤销
+                continue
+            heapq.heappush(heap, (max(release_time, now), _COMPLETE, next(seq), data_id))
+
+    def watch(waiter, now):
+        waiter['remaining'] = {data_id for data_id in waiter['data_ids'] if data_id not in cache.cache}
+        if not waiter['remaining']:
+            ready(waiter, now)
+        for data_id in waiter['remaining']:
+            waiting_on[data_id].append(waiter)
+
+    def admit_batches(now):
+        for ticket in list(cache.admitted_batches):
+            cache.admitted_batches.discard(ticket)
+            watch(batch_waiters.pop(ticket), now)
+
+    while heap:
+        now, kind, _, payload = heapq.heappop(heap)
+        if kind == _TRACE:
+            data_ids, is_batch, releases = payload
+            n_requests += len(data_ids)
+            hits += sum(data_id in cache.cache for data_id in data_ids)
+            waiter = {'start': now, 'data_ids': data_ids, 'releases': releases, 'ready': False, 'cancelled': False}
+            for data_id, release in zip(data_ids, releases):
+                if release is not None and release[1]:
+                    heapq.heappush(heap, (release[0], _CANCEL, next(seq), (waiter, data_id)))
+            if is_batch:
+                admitted, ticket = cache.request_batch(data_ids)
+                if admitted:
+                    watch(waiter, now)
+                else:
+                    batch_waiters[ticket] = waiter
+            else:
+                cache.request_load(data_ids[0])
+                watch(waiter, now)
+        elif kind == _COMPLETE:
+            cache.on_complete(payload)
+        elif kind == _CANCEL:
+            waiter, data_id = payload
+            # 已就绪的按 COMPLETE 处理（见 ready）；客户端只会在准入后撤销批量请求中的数据
+            if not waiter['ready'] and 'remaining' in waiter:
+                cache.cancel_request(data_id)
+                if not waiter['cancelled']:
+                    waiter['cancelled'] = True
+                    n_cancelled += 1
+        else:
+            cache._actually_load_data(payload)
+            loading = None
+            for waiter in waiting_on.pop(payload, []):
+                if waiter['cancelled']:
+                    continue
+                waiter['remaining'].discard(payload)
+                if not waiter['remaining']:
+                    ready(waiter, now)
+        admit_batches(now)
+
+        if loading is None and not cache.load_queue.empty():
+            loading = cache.load_queue.get()
+            skipped = loading in cache.cache or not cache.cache_order.check_exist(loading)
+            duration = 0 if skipped else sizes.get(loading, 0) / throughput
+            heapq.heappush(heap, (now + duration, _LOAD_DONE, next(seq), loading))
+        peak_usage = max(peak_usage, cache.cache_usage)
+
+    return {
+        'cache_size': cache_size,
+        'eviction': eviction,
+        'requests': n_requests,
+        'hit_rate': hits / n_requests if n_requests else 0.0,
+        'loads': cache.n_loads,
+        'bytes_loaded': cache.bytes_loaded,
+        'mean_wait': float(np.mean(waits)) if waits else 0.0,
+        'p95_wait': float(np.percentile(waits, 95)) if waits else 0.0,
+        'max_wait': float(np.max(waits)) if waits else 0.0,
+        'peak_usage': peak_usage,
+        'cancelled': n_cancelled,
+        # 回放结束时仍未就绪的请求（例如容量小于单个批量请求且一直有数据被占用）
+        'unfinished': len(requests) - len(waits) - n_cancelled,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an access trace against DataCache admission/eviction.')
+    parser.add_argument('trace_file')
+    parser.add_argument('--capacity', type=float, nargs='+', default=[20], help='cache sizes in GB')
+    parser.add_argument('--eviction', nargs='+', default=['all_unused'], choices=['all_unused', 'on_demand'])
+    parser.add_argument('--throughput', type=float, default=500, help='load throughput in MB/s')
+    args = parser.parse_args()
+
+    # DataCache 每次加载/淘汰都会打印日志，模拟时只保留警告
+    logging.getLogger('cache_logger').setLevel(logging.WARNING)
+
+    requests, sizes = load_trace(args.trace_file)
+    print(f"{len(requests)} requests, {len(sizes)} distinct data, {sum(sizes.values()) / 1024**3:.2f} GB")
+    print(f"{'capacity':>9} {'eviction':>11} {'hit_rate':>9} {'loaded_GB':>10} {'loads':>7} "
+          f"{'mean_wait':>10} {'p95_wait':>9} {'max_wait':>9} {'peak_GB':>8} {'cancelled':>9} {'unfinished':>10}")
+    for cache_size in args.capacity:
+        for eviction in args.eviction:
+            stats = simulate(requests, sizes, cache_size, eviction, args.throughput * 1024**2)
+            print(f"{cache_size:>9g} {eviction:>11} {stats['hit_rate']:>9.2%} "
+                  f"{stats['bytes_loaded'] / 1024**3:>10.2f} {stats['loads']:>7} "
+                  f"{stats['mean_wait']:>10.2f} {stats['p95_wait']:>9.2f} {stats['max_wait']:>9.2f} "
+                  f"{stats['peak_usage'] / 1024**3:>8.2f} {stats['cancelled']:>9} {stats['unfinished']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+集群模式：多个缓存节点按一致性哈希划分 data_id 的归属。
+
+- HashRing: 一致性哈希环，节点以 'host:port' 标识；按日期放置，同一天的各表及其派生视图位于同一节点
+- 客户端（DataLoader）用同一份节点列表计算 owner，直接访问本机上的 owner；
+  owner 在其他机器上时访问本机节点，由本机节点从 owner 拉取数据并缓存为读穿 L2
+- 节点间通过 FETCH 命令传输共享内存中的原始字节
+"""
+
+import bisect
+import hashlib
+import json
+import socket
+import time
+
+import numpy as np
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=100):
+        """
+        :param nodes: 节点列表，每个元素形如 'host:port'
+        :param replicas: 每个节点在环上的虚拟节点数
+        """
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        self._ring = []  # 排序后的 (hash, node)
+        for node in self.nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash(f'{node}#{i}'), node))
+        self._ring.sort()
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """返回 key 所属的节点"""
+        if not self._ring:
+            raise ValueError('hash ring has no nodes')
+        idx = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[idx][1]
+
+
+def placement_key(data_id):
+    """data_id 形如 '<date>_<table>'，按日期放置"""
+    return data_id.split('_', 1)[0]
+
+
+def parse_node(node):
+    host, port = node.rsplit(':', 1)
+    return host, int(port)
+
+
+_local_hosts = None
+
+
+def is_local_host(host):
+    """判断 host 是否指向本机"""
+    global _local_hosts
+    if host in ('localhost', '127.0.0.1'):
+        return True
+    if _local_hosts is None:
+        names = {'localhost', socket.gethostname(), socket.getfqdn()}
+        addrs = set()
+        for name in names:
+            try:
+                addrs.update(socket.gethostbyname_ex(name)[2])
+            except socket.error:
+                pass
+        _local_hosts = names | addrs
+    if host in _local_hosts:
+        return True
+    try:
+        addr = socket.gethostbyname(host)
+    except socket.error:
+        return False
+    return addr.startswith('127.') or addr in _local_hosts
+
+
+def send_command(host, port, command):
+    """发送一条短命令并返回响应"""
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect((host, port))
+        client_socket.send(command.encode())
+        return recv_all(client_socket)
+    finally:
+        client_socket.close()
+
+
+def recv_all(sock):
+    """读取完整响应直到服务端关闭连接（数据信息随列数、字典和索引增长，可能超过一次 recv 的长度）"""
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return b''.join(chunks).decode()
+        chunks.append(chunk)
+
+
+def _recv_header(sock):
+    """读取以换行结尾的响应头，返回 (header, 已多读的负载字节)"""
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('connection closed while reading header')
+        newline = chunk.find(b'\n')
+        if newline >= 0:
+            chunks.append(chunk[:newline])
+            return b''.join(chunks).decode(), chunk[newline + 1:]
+        chunks.append(chunk)
+
+
+def _recv_into(sock, view, leftover=b''):
+    """把负载读入预分配的缓冲区 view"""
+    received = len(leftover)
+    view[:received] = leftover
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('connection closed while receiving payload')
+        received += n
+
+
+def format_fetch(data_id, rows=None, columns=None):
+    """
+    FETCH 命令格式: 'FETCH#<data_id>[#<start>:<stop>[#<col1,col2,...>]]'
+    :param rows: (start, stop) 行区间，None 表示全部行；start/stop 可为 None
+    :param columns: 列名列表，None 表示全部列
+    """
+    command = f"FETCH#{data_id}"
+    if rows is None and columns is None:
+        return command
+    start, stop = rows if rows is not None else (None, None)
+    command += f"#{'' if start is None else start}:{'' if stop is None else stop}"
+    if columns is not None:
+        command += f"#{','.join(columns)}"
+    return command
+
+
+def parse_fetch(data):
+    """解析 FETCH 命令，返回 (data_id, (start, stop) 或 None, columns 或 None)"""
+    parts = data.split('#')
+    data_id = parts[1]
+    rows = None
+    columns = None
+    if len(parts) > 2 and parts[2]:
+        start, stop = parts[2].split(':')
+        rows = (int(start) if start else None, int(stop) if stop else None)
+    if len(parts) > 3 and parts[3]:
+        columns = parts[3].split(',')
+    return data_id, rows, columns
+
+
+def _parse_shape(shape_str):
+    """'(rows, cols)' -> (rows, cols)"""
+    return tuple(int(dim) for dim in shape_str[1:-1].split(',') if dim.strip())
+
+
+def fetch_array(host, port, data_id, rows=None, columns=None, out=None):
+    """
+    通过 FETCH 拉取远端节点共享内存中的数据，可只取部分行/列
+    响应格式: 'OK|shape|dtype|columns|nbytes|dicts\\n' + 原始字节；未缓存时为 'WAIT'
+    :param out: 预分配的接收数组，形状与类型须与结果一致；None 时自动分配
+    :return: (array, columns, dicts)，dicts 为 {字典编码列: 字典值列表}；远端尚未缓存时返回 None
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect((host, port))
+        client_socket.send(format_fetch(data_id, rows, columns).encode())
+        header, leftover = _recv_header(client_socket)
+        if not header.startswith('OK'):
+            return None
+        # 字典值中可能含 '|'，放在最后一个字段
+        _, shape_str, dtype_str, columns_str, nbytes_str, dicts_str = header.split('|', 5)
+        shape = _parse_shape(shape_str)
+        columns = columns_str.split(',') if columns_str else []
+        dtype = np.dtype(dtype_str)
+        if out is None:
+            array = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or out.dtype != dtype or not out.flags.c_contiguous:
+            raise ValueError(f'out buffer does not match {shape} {dtype} when fetching {data_id}')
+        else:
+            array = out
+        view = memoryview(array).cast('B')
+        if len(view) != int(nbytes_str):
+            raise ValueError(f'size mismatch when fetching {data_id}')
+        _recv_into(client_socket, view, leftover)
+        return array, columns, json.loads(dicts_str)
+    finally:
+        client_socket.close()
+
+
+def fetch_from_owner(host, port, data_id, timeout=600, poll_interval=1, allocate=None):
+    """
+    从 owner 节点读取数据：REQUEST 固定数据 -> 轮询 CHECK 直到就绪 -> FETCH -> COMPLETE 释放
+    :param allocate: allocate(shape, dtype) -> 接收数组，按数据信息中的形状与类型预分配（例如直接分配在本地共享内存段中）；
+                     None 时由 fetch_array 自动分配
+    :return: (array, columns, dicts)；超时或失败返回 None
+    """
+    start_time = time.time()
+    response = send_command(host, port, f"REQUEST#{data_id}")
+    while response.startswith("WAIT"):
+        if time.time() - start_time > timeout:
+            send_command(host, port, f"CANCEL#{data_id}")
+            return None
+        time.sleep(poll_interval)
+        response = send_command(host, port, f"CHECK#{data_id}")
+    if response == "INVALID_REQUEST":
+        return None
+    shm_name, shape_str, dtype_str = response.split('|', 3)[:3]
+    try:
+        out = None if allocate is None else allocate(_parse_shape(shape_str), np.dtype(dtype_str))
+        return fetch_array(host, port, data_id, out=out)
+    finally:
+        send_command(host, port, f"COMPLETE#{data_id}#{shm_name}")
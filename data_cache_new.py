@@ -1,16 +1,23 @@
 import os
 import fcntl
-import posix_ipc
-import mmap
 import pandas as pd
 import numpy as np
 import json
+import hashlib
 import threading
 import queue
+import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import sys
 
 from priority_queue import PriorityQueue
+from derived_views import DEFAULT_VIEWS
+from cluster import HashRing, placement_key, parse_node, fetch_from_owner
+import shm_utils
+from file_watcher import InotifyWatcher
 
 logger = logging.getLogger('cache_logger')
 logger.setLevel(logging.DEBUG)
@@ -32,7 +39,8 @@ class DataCache:
     def __init__(self, config_file='config.json'):
         config = json.load(open(config_file))
 
-        self.lock_file = 'datacache.lock'
+        # 同一台机器上运行多个节点时，每个节点需配置不同的 lock_file 和 shm_prefix
+        self.lock_file = config.get('lock_file', 'datacache.lock')
         self.fp = open(self.lock_file, 'w')
         try:
             fcntl.lockf(self.fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -40,24 +48,97 @@ class DataCache:
             logger.error("Another instance is running, exiting...")
             exit()
 
+        self._init_state(config)
+
+        # 后台加载线程
+        self._stop_event = threading.Event()
+
+        self.loader_thread = threading.Thread(target=self._loader_loop, daemon=True)
+        self.loader_thread.start()
+
+        # 集群模式下从 owner 读穿拉取在独立的线程池中进行，不占用加载线程：
+        # 否则两个节点互相拉取时，各自 owner 侧的加载排在被阻塞的加载线程之后，双方都要等到超时
+        self.fetch_pool = ThreadPoolExecutor(max_workers=config.get('remote_fetch_workers', 4))
+
+        # 可选：监听 data_path 下文件的改写，主动使缓存失效（NFS 上其他机器的改写无法收到通知，仍依赖 REQUEST 时的检查）
+        self.watcher = None
+        if config.get('watch_data_path', False):
+            self.watcher = InotifyWatcher(self.data_path, self._on_file_changed)
+            if not self.watcher.start():
+                self.watcher = None
+
+    def _init_state(self, config):
+        """
+        初始化缓存管理的状态（不涉及锁文件和后台线程，离线模拟器 cache_simulator 复用此方法）
+        """
         # --- 共享资源 ---
         self.cache = {}
         self.cache_order = PriorityQueue(min_queue=True)
         self.request_queue = PriorityQueue(min_queue=False)
+        # 批量请求：整体排队，按到达顺序整体准入，避免作业只固定了部分输入而互相等待
+        self.batch_queue = deque()  # (ticket, data_ids)
+        self.admitted_batches = set()
+        self._batch_tickets = itertools.count(1)
         self.cache_usage = 0
 
         self.cache_capacity = config.get('cache_size', 20) * 1024**3
         self.data_path = config.get('data_path', '/home/haolinl/converted_parquet')
+        self.shm_prefix = config.get('shm_prefix', 'shm')
+        # 共享内存段的页与 NUMA 设置，见 shm_utils
+        # hugepages: 'off' | 'madvise' | 'hugetlbfs'；numa: null | 节点号 | 'interleave' | 节点列表
+        self.hugepages = config.get('hugepages', 'off')
+        self.hugetlbfs_path = config.get('hugetlbfs_path', shm_utils.DEFAULT_HUGETLBFS_PATH)
+        self.numa = config.get('numa')
+
+        # 集群模式：cluster_nodes 为 'host:port' 列表，node_name 为本节点在列表中的名字
+        cluster_nodes = config.get('cluster_nodes')
+        self.ring = HashRing(cluster_nodes) if cluster_nodes else None
+        self.node_name = config.get('node_name', f"{config.get('host', 'localhost')}:{config.get('port', 6000)}")
+        self.remote_timeout = config.get('remote_timeout', 600)
+
+        # 派生视图：视图名 -> (基础表, 视图函数)；基础表 data_id -> 依赖它的视图 data_id 集合
+        self.views = dict(DEFAULT_VIEWS)
+        self.view_deps = {}
+        # 已入load_queue但尚未加载完成的数据，其预估占用的空间
+        self._pending_size = {}
+        # 加载失败的数据: data_id -> 错误信息，CHECK 时返回 INVALID_REQUEST，再次 REQUEST 时清除
+        self.failed_loads = {}
+
+        # 数据版本：REQUEST 时比较源文件指纹，源文件被改写则换用新段
+        # fingerprint: 'stat'（mtime+size）| 'footer'（stat 变化时再比较 parquet footer 的哈希，忽略仅 touch 的情况）| 'off'
+        self.fingerprint_mode = config.get('fingerprint', 'stat')
+        self._versions = {}
+        # 已过期但仍被客户端使用的旧段: data_id -> [{'shm_name', 'size', 'refs'}]
+        self.retired = {}
+
+        # 字符串/类别列的共享字典，同一张表的同名列跨日期复用，只追加不删除，已有编码保持不变
+        # (table, column) -> {'values', 'index', 'shm_name', 'dtype', 'size', 'version'}
+        self.dictionaries = {}
+        # 被新版本取代但仍被缓存数据引用的旧字典段: shm_name -> size，没有数据引用后才 unlink
+        self.old_dictionaries = {}
+        # 字典段（包括旧版本）的总大小，计入 cache_usage，但不在 cache 中、不能被淘汰
+        self.dictionary_usage = 0
+
+        # 表内时间索引：按 (股票, 时间) 排序后发布每只股票的行区间和稀疏时间采样，客户端二分查找时间窗口
+        # time_index: 'off'（默认）| 'verify'（已有序才建索引）| 'sort'（加载时排序）
+        self.time_index = config.get('time_index', 'off')
+        self.sort_keys = config.get('sort_keys', {
+            'trade': ['stock_code', 'TradeTime'],
+            'order': ['stock_code', 'OrderTime'],
+            'tick': ['stock_code', 'time'],
+        })
+        self.index_stride = config.get('index_stride', 1024)
+
+        # 淘汰策略：'all_unused'（有请求排队时淘汰所有未被使用的数据，默认）| 'on_demand'（只淘汰到放得下为止）
+        self.eviction = config.get('eviction', 'all_unused')
+
+        # 加载吞吐（字节/秒），初始为配置的估计值（MB/s），之后按实际加载的耗时滑动平均，用于估计等待时间
+        self.load_throughput = config.get('load_throughput', 200) * 1024**2
 
         # 线程锁，用于保护以上共享数据结构
         self._cache_lock = threading.Lock()
-
-        # 后台加载队列 & 线程
+        # 后台加载队列
         self.load_queue = queue.Queue()
-        self._stop_event = threading.Event()
-
-        self.loader_thread = threading.Thread(target=self._loader_loop, daemon=True)
-        self.loader_thread.start()
 
     def __del__(self):
         fcntl.lockf(self.fp, fcntl.LOCK_UN)
@@ -74,7 +155,19 @@ class DataCache:
                 data_id = self.load_queue.get(timeout=1)  # 如果1秒内没新任务，会抛 queue.Empty
             except queue.Empty:
                 continue
-            self._actually_load_data(data_id)
+            # 从磁盘读取的表：视图读取的是基础表，基础表已在cache中时没有磁盘读取
+            with self._cache_lock:
+                source_id = self._source_id(data_id)
+                read_from_disk = source_id not in self.cache and self._get_remote_owner(data_id) is None
+            start_time = time.time()
+            try:
+                self._actually_load_data(data_id)
+            except Exception as e:
+                # 单个数据加载失败不能让加载线程退出，否则之后的加载都会一直等待
+                self._fail_load(data_id, e)
+            else:
+                if read_from_disk:
+                    self._observe_load(source_id, time.time() - start_time)
 
             self.load_queue.task_done()
 
@@ -83,139 +176,869 @@ class DataCache:
         真正执行磁盘IO + 写共享内存的函数
         """
         with self._cache_lock:
-            # 避免重复加载
+            # 避免重复加载（例如基础表已被某个视图顺带加载）
             if data_id in self.cache:
+                self.cache_usage -= self._pending_size.pop(data_id, 0)
+                return
+            if not self.cache_order.check_exist(data_id):
+                # 加载前所有请求都已取消
                 return
 
-            data_path = self._get_data_path(data_id)
-            df = pd.read_parquet(data_path)
-            array = df.to_numpy()
+            owner = self._get_remote_owner(data_id)
+            if owner is None:
+                if self._is_view(data_id):
+                    self._load_view(data_id)
+                else:
+                    self._load_table(data_id)
+                return
 
-            shm_name = f"/shm_{data_id}"
-            try:
-                shm = posix_ipc.SharedMemory(
-                    name=shm_name,
-                    flags=posix_ipc.O_CREAT | posix_ipc.O_EXCL,
-                    mode=0o600,
-                    size=array.nbytes
-                )
-            except posix_ipc.ExistentialError:
-                shm = posix_ipc.SharedMemory(name=shm_name)
-                if shm.size < array.nbytes:
-                    os.ftruncate(shm.fd, array.nbytes)
-
-            shm_mmap = mmap.mmap(shm.fd, shm.size, access=mmap.ACCESS_WRITE)
-            shm_arr = np.ndarray(array.shape, dtype=array.dtype, buffer=shm_mmap)
-            shm_arr[:] = array[:]
-
-            self.cache[data_id] = {
-                'shm_name': shm_name,
-                'shape': array.shape,
-                'dtype': array.dtype
-            }
-            # 实际加载后，更正cache_usage
-            self.cache_usage += array.nbytes
-            self.cache_usage -= self._get_file_size(data_path)
+        self.fetch_pool.submit(self._remote_load, owner, data_id)
+
+    def _remote_load(self, owner, data_id):
+        """在 fetch_pool 中执行：从 owner 读穿拉取并登记到cache；拉取时不持锁"""
+        try:
+            self._do_remote_load(owner, data_id)
+        except Exception as e:
+            # 线程池会吞掉异常，这里记录下来
+            self._fail_load(data_id, e)
+
+    def _do_remote_load(self, owner, data_id):
+        fingerprint = self._fingerprint(data_id)
+        segment = {}
+
+        def allocate(shape, dtype):
+            # 直接接收到本节点的新段中，不经过私有缓冲区再拷贝一次（多 GB 的表否则内存峰值翻倍）
+            with self._cache_lock:
+                name = self._next_segment_name(data_id)
+            segment['shm_name'], segment['size'], segment['mmap'] = self._create_mapped_segment(
+                name, int(np.prod(shape)) * dtype.itemsize)
+            return np.ndarray(shape, dtype=dtype, buffer=segment['mmap'])
+
+        fetched = self._fetch_from_owner(owner, data_id, allocate)
+        stored = False
+        try:
+            with self._cache_lock:
+                if data_id in self.cache:
+                    self.cache_usage -= self._pending_size.pop(data_id, 0)
+                elif not self.cache_order.check_exist(data_id):
+                    return
+                elif fetched is not None:
+                    self._store_fetched(data_id, segment['shm_name'], segment['size'], *fetched)
+                    stored = True
+                    self.cache[data_id]['fingerprint'] = fingerprint
+                elif self._is_view(data_id):
+                    self._load_view(data_id)
+                else:
+                    # owner 不可用时退回直接读 parquet
+                    self._load_table(data_id)
+        finally:
+            fetched = None
+            if segment:
+                with self._cache_lock:
+                    registered = self.cache.get(data_id, {}).get('shm_name') == segment['shm_name']
+                if not registered:
+                    # 拉取失败或数据已不再需要；映射随接收数组一起释放
+                    shm_utils.unlink_segment(segment['shm_name'])
+                elif stored:
+                    segment['mmap'].close()
+
+    def _fail_load(self, data_id, error):
+        """
+        加载失败：释放预估占位和等待它的请求的引用，登记失败，等待的客户端 CHECK 时得到 INVALID_REQUEST，
+        否则它们会一直收到 WAIT 直到超时
+        """
+        logger.error(f"[DataCache] Error loading {data_id}: {error}")
+        with self._cache_lock:
+            self.cache_usage -= self._pending_size.pop(data_id, 0)
+            if data_id in self.cache:
+                # 登记后才失败（例如写时间索引时），段已不完整
+                self._remove_data(data_id)
+            else:
+                self.cache_order.remove(data_id)
+            self.failed_loads[data_id] = str(error)
+            self._manage_cache()
+
+    def _observe_load(self, source_id, elapsed):
+        """按读取的文件大小更新加载吞吐，与 _estimate_size 的口径一致（视图结果的大小与加载耗时无关）"""
+        with self._cache_lock:
+            if source_id not in self.cache or elapsed <= 0:
+                return
+            file_size = self._estimate_size_or_zero(source_id)
+            if file_size > 0:
+                self.load_throughput = 0.7 * self.load_throughput + 0.3 * file_size / elapsed
+
+    def _get_remote_owner(self, data_id):
+        """集群模式下返回 data_id 所属的其他节点，本节点所属或非集群模式返回 None"""
+        if self.ring is None:
+            return None
+        owner = self.ring.get_node(placement_key(data_id))
+        return None if owner == self.node_name else owner
+
+    def _fetch_from_owner(self, owner, data_id, allocate=None):
+        host, port = parse_node(owner)
+        try:
+            fetched = fetch_from_owner(host, port, data_id, timeout=self.remote_timeout, allocate=allocate)
+        except (OSError, ValueError) as e:
+            logger.error(f"[DataCache] Failed to fetch {data_id} from {owner}: {e}")
+            return None
+        if fetched is not None:
+            logger.info(f"[DataCache] Fetched {data_id} from owner {owner}")
+        return fetched
+
+    def _load_table(self, data_id):
+        # 读文件前取指纹，读取期间发生的改写会在下次检查时被发现
+        fingerprint = self._fingerprint(data_id)
+        df = pd.read_parquet(self._get_data_path(data_id))
+        table = data_id.split('_', 1)[1]
+        dict_columns = self._encode_strings(table, df)
+        columns = [str(col) for col in df.columns]
+        array = df.to_numpy()
+        if self.time_index == 'sort':
+            array = self._sort_rows(table, array, columns)
+        self._store_array(data_id, array, columns)
+        self._store_time_index(data_id, table, array, columns)
+        self.cache[data_id]['fingerprint'] = fingerprint
+        self.cache[data_id]['table'] = table
+        self.cache[data_id]['dict_columns'] = dict_columns
+        self._snapshot_dictionaries(data_id)
+
+    def _store_fetched(self, data_id, shm_name, size, array, columns, dicts):
+        """登记已接收到本节点段 shm_name 中的数据，字典编码列在段内按本节点的字典重新编码"""
+        table = data_id.split('_', 1)[1]
+        for col, values in dicts.items():
+            index = self._extend_dictionary(table, col, values)
+            # 末尾的 -1 对应缺失值编码 -1
+            remap = np.array([index[value] for value in values] + [-1])
+            col_idx = columns.index(col)
+            array[:, col_idx] = remap[array[:, col_idx].astype(np.int64)]
+        self._register_array(data_id, shm_name, size, array.shape, array.dtype, columns)
+        self._store_time_index(data_id, table, array, columns)
+        self.cache[data_id]['table'] = table
+        self.cache[data_id]['dict_columns'] = list(dicts)
+        self._snapshot_dictionaries(data_id)
 
-            logger.info(f"[DataCache] Loaded data {data_id} into shared memory {shm_name}")
+    def _sort_rows(self, table, array, columns):
+        """按 (股票, 时间) 排序"""
+        keys = self.sort_keys.get(table)
+        if not keys or not all(key in columns for key in keys):
+            return array
+        stock_col, time_col = (columns.index(key) for key in keys)
+        order = np.lexsort((array[:, time_col], array[:, stock_col]))
+        return array[order]
 
+    def _store_time_index(self, data_id, table, array, columns):
+        """
+        数据按股票分组、组内按时间有序时，发布时间索引到附属段 '<数据段>_idx'，float64 数组 (n_stocks + n_samples, 3)：
+        - 前 n_stocks 行: (股票, 起始行, 结束行)，按股票（编码）升序
+          不要求各组按编码排列：字典只追加，按字符串排序的文件中新出现的股票编码可能比排在它后面的股票大
+        - 之后每行: (时间, 行号, 0)，每 index_stride 行采样一次
+        """
+        keys = self.sort_keys.get(table)
+        n_rows = array.shape[0] if array.ndim == 2 else 0
+        if self.time_index == 'off' or not keys or not all(key in columns for key in keys) or n_rows == 0:
+            return
+        stock = array[:, columns.index(keys[0])].astype(np.float64)
+        times = array[:, columns.index(keys[1])].astype(np.float64)
+        stock_change = np.diff(stock) != 0
+        boundaries = np.flatnonzero(stock_change) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [n_rows]])
+        grouped = len(starts) == len(np.unique(stock))
+        if not (grouped and np.all(stock_change | (np.diff(times) >= 0))):
+            logger.warning(f"[DataCache] {data_id} is not sorted by {keys}, time index skipped")
+            return
+        # 客户端按编码二分查找股票
+        order = np.argsort(stock[starts], kind='stable')
+        starts, ends = starts[order], ends[order]
+        sample_rows = np.arange(0, n_rows, self.index_stride)
+        index = np.vstack([
+            np.column_stack([stock[starts], starts, ends]),
+            np.column_stack([times[sample_rows], sample_rows, np.zeros(len(sample_rows))]),
+        ]).astype(np.float64)
+
+        info = self.cache[data_id]
+        index_name, index_size = self._write_segment(f"/{self.shm_prefix}_{data_id}_v{self._versions[data_id]}_idx", index)
+        info.update(index_shm=index_name, index_shape=index.shape, n_stocks=len(starts), sort_keys=list(keys))
+        info['size'] += index_size
+        self.cache_usage += index_size
+
+    def _write_segment(self, name, array):
+        """把小数组（字典、索引）写入普通页共享内存段，返回 (shm_name, size)"""
+        shm_name, fd, size = shm_utils.create_segment(name, array.nbytes)
+        try:
+            shm_mmap = shm_utils.map_segment(fd, size, write=True)
+        finally:
+            os.close(fd)
+        shm_arr = np.ndarray(array.shape, dtype=array.dtype, buffer=shm_mmap)
+        shm_arr[:] = array
+        del shm_arr
+        shm_mmap.close()
+        return shm_name, size
+
+    def _unlink_entry(self, info):
+        shm_utils.unlink_segment(info['shm_name'])
+        if 'index_shm' in info:
+            shm_utils.unlink_segment(info['index_shm'])
+
+    def _encode_strings(self, table, df):
+        """
+        把字符串/类别列原地替换为整数编码（缺失值为 -1），返回被编码的列名
+        object 数组放进共享内存只是一堆指针，编码后整张表是数值数组，按股票筛选也变成整数比较
+        """
+        dict_columns = []
+        for col in df.columns:
+            dtype = df[col].dtype
+            if not (pd.api.types.is_object_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype)
+                    or pd.api.types.is_string_dtype(dtype)):
+                continue
+            values = df[col].astype(object)
+            self._extend_dictionary(table, str(col), pd.unique(values.dropna()))
+            categories = self.dictionaries[(table, str(col))]['values']
+            df[col] = pd.Categorical(values, categories=categories).codes.astype(np.int32)
+            dict_columns.append(str(col))
+        return dict_columns
+
+    def _extend_dictionary(self, table, column, values):
+        """把新值追加到 (table, column) 的字典，有新值时发布新版本的字典段；返回 值->编码 映射"""
+        key = (table, column)
+        entry = self.dictionaries.setdefault(key, {
+            'values': [], 'index': {}, 'shm_name': None, 'dtype': None, 'size': 0, 'version': 0
+        })
+        new_values = [value for value in values if value not in entry['index']]
+        if new_values or entry['shm_name'] is None:
+            for value in new_values:
+                entry['index'][value] = len(entry['values'])
+                entry['values'].append(value)
+            self._publish_dictionary(key)
+        return entry['index']
+
+    def _publish_dictionary(self, key):
+        """
+        字典以定长 unicode 数组写入新的共享内存段（字典只追加，旧版本是新版本的前缀）；
+        旧版本段保留到没有缓存数据引用它为止，拿到旧版本信息的客户端仍能打开
+        """
+        table, column = key
+        entry = self.dictionaries[key]
+        values = np.array([str(value) for value in entry['values']] or [''], dtype=str)[:len(entry['values'])]
+        entry['version'] += 1
+        shm_name, size = self._write_segment(f"/{self.shm_prefix}_dict_{table}_{column}_v{entry['version']}", values)
+
+        if entry['shm_name'] is not None:
+            self.old_dictionaries[entry['shm_name']] = entry['size']
+        entry.update(shm_name=shm_name, dtype=str(values.dtype), size=size)
+        self.cache_usage += size
+        self.dictionary_usage += size
+        logger.info(f"[DataCache] Published dictionary {table}.{column} with {len(entry['values'])} values")
+        self._release_dictionaries()
+
+    def _snapshot_dictionaries(self, data_id):
+        """记录数据加载时各编码列的字典版本，get_cache_info 返回该版本，该版本在数据被移除前不会被 unlink"""
+        info = self.cache[data_id]
+        info['dict_versions'] = {}
+        for col in info['dict_columns']:
+            entry = self.dictionaries[(info['table'], col)]
+            info['dict_versions'][col] = (entry['shm_name'], entry['dtype'], len(entry['values']))
+
+    def _release_dictionaries(self):
+        """unlink 不再被缓存数据（包括仍在使用的已过期段）引用的旧版本字典段"""
+        referenced = {
+            version[0] for info in self.cache.values() for version in info.get('dict_versions', {}).values()
+        }
+        referenced.update(
+            version[0] for records in self.retired.values() for record in records
+            for version in record.get('dict_versions', {}).values()
+        )
+        for shm_name in list(self.old_dictionaries):
+            if shm_name not in referenced:
+                shm_utils.unlink_segment(shm_name)
+                size = self.old_dictionaries.pop(shm_name)
+                self.cache_usage -= size
+                self.dictionary_usage -= size
+
+    def _load_view(self, data_id):
+        """
+        在基础表上计算派生视图；基础表不在cache中时先加载基础表
+        """
+        date, view_name = data_id.split('_', 1)
+        base_table, func = self.views[view_name]
+        base_id = f'{date}_{base_table}'
+        if base_id in self.cache and self._is_stale(base_id):
+            # 不在旧的基础表上计算
+            self._retire(base_id)
+        if base_id not in self.cache:
+            self._load_table(base_id)
+            # 仅作为视图输入被加载的基础表权重为0，可被正常淘汰
+            self.cache_order.increase(base_id, 0)
+
+        base_info = self.cache[base_id]
+        fd, size = shm_utils.open_segment(base_info['shm_name'])
+        try:
+            shm_mmap = shm_utils.map_segment(fd, size)
+        finally:
+            os.close(fd)
+        base_arr = np.ndarray(base_info['shape'], dtype=base_info['dtype'], buffer=shm_mmap)
+        try:
+            result, columns = func(base_arr, base_info['columns'])
+            result = np.array(result, order='C')
+        finally:
+            del base_arr
             shm_mmap.close()
-            shm.close_fd()
+
+        self._store_array(data_id, result, columns)
+        self.cache[data_id]['base'] = base_id
+        self.cache[data_id]['fingerprint'] = base_info.get('fingerprint')
+        # 视图中保留了基础表编码列（如 stock_code）的，沿用基础表的字典
+        self.cache[data_id]['table'] = base_table
+        self.cache[data_id]['dict_columns'] = [
+            col for col in base_info.get('dict_columns', []) if col in columns
+        ]
+        self._snapshot_dictionaries(data_id)
+        self.view_deps.setdefault(base_id, set()).add(data_id)
+
+    def _next_segment_name(self, data_id):
+        """段名带版本号，数据更新后新旧段可以同时存在；调用方持有锁"""
+        version = self._versions.get(data_id, 0) + 1
+        self._versions[data_id] = version
+        return f"/{self.shm_prefix}_{data_id}_v{version}"
+
+    def _create_mapped_segment(self, name, nbytes):
+        """按大页与 NUMA 设置创建数据段并可写映射，返回 (shm_name, size, shm_mmap)"""
+        shm_name, fd, size = shm_utils.create_segment(
+            name, nbytes, hugepages=self.hugepages, hugetlbfs_path=self.hugetlbfs_path
+        )
+        try:
+            shm_mmap = shm_utils.map_segment(fd, size, write=True, hugepages=self.hugepages)
+        finally:
+            os.close(fd)
+        # 在首次写入（缺页）前设置 NUMA 策略，页面才会按策略分配
+        shm_utils.bind_numa(shm_mmap, size, self.numa)
+        return shm_name, size, shm_mmap
+
+    def _store_array(self, data_id, array, columns):
+        """将数组写入共享内存并登记到cache"""
+        shm_name, size, shm_mmap = self._create_mapped_segment(self._next_segment_name(data_id), array.nbytes)
+        shm_arr = np.ndarray(array.shape, dtype=array.dtype, buffer=shm_mmap)
+        shm_arr[:] = array[:]
+        del shm_arr
+        self._register_array(data_id, shm_name, size, array.shape, array.dtype, columns)
+        shm_mmap.close()
+
+    def _register_array(self, data_id, shm_name, size, shape, dtype, columns):
+        """登记已写入共享内存段 shm_name 的数据"""
+        self.cache[data_id] = {
+            'shm_name': shm_name,
+            'shape': shape,
+            'dtype': dtype,
+            'columns': columns,
+            'size': size
+        }
+        # 实际加载后，用实际大小替换预估大小
+        self.cache_usage += size
+        self.cache_usage -= self._pending_size.pop(data_id, 0)
+
+        logger.info(f"[DataCache] Loaded data {data_id} into shared memory {shm_name}")
 
     def _manage_cache(self):
         """淘汰和加载新的数据"""
         # 调用该方法必须先获取锁
-        if self.request_queue.empty():
+        if self.request_queue.empty() and not self.batch_queue:
         # 若没有pending request，不作处理
             return
 
-        while (not self.cache_order.empty()) and (self.cache_order.front()[1] == 0):
+        while (not self.cache_order.empty()) and (self.cache_order.front()[1] == 0) \
+                and (self.eviction == 'all_unused' or self.cache_usage >= self.cache_capacity):
             # 淘汰权重为0的数据
             least_used_key = self.cache_order.front()[0]
             logger.info(f"[DataCache] removing {least_used_key}")
             self._remove_data(least_used_key)
 
+        while self.batch_queue and self._batch_fits(self.batch_queue[0][1]):
+            # 批量请求按到达顺序整体准入
+            ticket, data_ids = self.batch_queue.popleft()
+            self._admit_batch(ticket, data_ids)
+
+        if self.batch_queue:
+            # 队首批量请求放不下时不再准入单个请求，避免批量请求被饿死
+            return
+
         while (not self.request_queue.empty()) and (self.cache_usage < self.cache_capacity):
-            # 加载等待队列中权重最高的数据
+            # 加载等待队列中权重最高的数据，权重即等待的请求数，每个请求各持有一个引用
             next_data_id, next_data_weight = self.request_queue.pop()
-            self._ready_to_load(next_data_id)
+            self._ready_to_load(next_data_id, next_data_weight)
+
+    def _batch_missing_size(self, data_ids):
+        """批量请求中尚未缓存、也未在加载中的数据的预估大小"""
+        return sum(
+            self._estimate_size(data_id) for data_id in set(data_ids)
+            if data_id not in self.cache and not self.cache_order.check_exist(data_id)
+        )
+
+    def _batch_fits(self, data_ids):
+        """
+        判断批量请求能否整体放入；未被使用（权重为0）的数据视为可淘汰
+        cache 中没有任何被使用的数据时总是放行，防止超过容量的批量请求永远等待（字典段不可淘汰，不算被使用）
+        """
+        needed = self._batch_missing_size(data_ids)
+        if self.cache_usage + needed <= self.cache_capacity:
+            return True
+        evictable = sum(
+            info['size'] for data_id, info in self.cache.items()
+            if self.cache_order.check_exist(data_id) and self.cache_order.get_weight(data_id) == 0
+        )
+        if self.cache_usage - evictable + needed <= self.cache_capacity:
+            return True
+        return self.cache_usage - self.dictionary_usage == evictable and not self.retired
+
+    def _admit_batch(self, ticket, data_ids):
+        needed = self._batch_missing_size(data_ids)
+        while (self.cache_usage + needed > self.cache_capacity
+               and not self.cache_order.empty() and self.cache_order.front()[1] == 0):
+            least_used_key = self.cache_order.front()[0]
+            logger.info(f"[DataCache] removing {least_used_key} for batch {ticket}")
+            self._remove_data(least_used_key)
+        for data_id in data_ids:
+            if data_id in self.cache:
+                self.cache_order.increase(data_id)
+            else:
+                self._ready_to_load(data_id)
+        self.admitted_batches.add(ticket)
+        logger.info(f"[DataCache] admitted batch {ticket}: {data_ids}")
 
     def _get_data_path(self, data_id):
         return os.path.join(self.data_path, f'{data_id}s.parquet')
+
+    def _is_view(self, data_id):
+        return data_id.split('_', 1)[-1] in self.views
+
+    def _source_id(self, data_id):
+        """视图返回其基础表的 data_id，基础表返回自身"""
+        if not self._is_view(data_id):
+            return data_id
+        date, view_name = data_id.split('_', 1)
+        return f'{date}_{self.views[view_name][0]}'
+
+    def _estimate_size(self, data_id):
+        """
+        加载前预估占用：基础表以原始文件大小预估；视图结果通常很小，按0预估，
+        但基础表不在cache中时需要顺带加载基础表，计入基础表的大小
+        """
+        if self._is_view(data_id):
+            base_id = self._source_id(data_id)
+            if base_id in self.cache or self.cache_order.check_exist(base_id):
+                return 0
+            return self._estimate_size(base_id)
+        return self._get_file_size(self._get_data_path(data_id))
     
+    def _estimate_size_or_zero(self, data_id):
+        try:
+            return self._estimate_size(data_id)
+        except OSError:
+            return 0
+
+    def _wait_estimate(self, data_id):
+        """
+        估计未缓存的 data_id 就绪前的排队情况，返回 (position, eta, overloaded)
+        - position: 包括自身在内，还要加载多少个数据
+        - eta: 按加载吞吐估计的秒数；需要等其他客户端释放内存时无法估计，为 -1
+        - overloaded: 正在使用的数据加上排在前面的数据超过容量，只有客户端 COMPLETE 后才能继续
+        """
+        pending = list(self._pending_size.items())
+        pending_bytes = sum(size for _, size in pending)
+        for i, (pending_id, _) in enumerate(pending):
+            if pending_id == data_id:
+                # 已在加载队列中
+                return i + 1, sum(size for _, size in pending[:i + 1]) / self.load_throughput, False
+
+        own_size = self._estimate_size_or_zero(data_id)
+        if self.cache_usage < self.cache_capacity and not self.batch_queue \
+                and not self.request_queue.check_exist(data_id):
+            # 请求时会直接进入加载队列
+            return len(pending) + 1, (pending_bytes + own_size) / self.load_throughput, False
+
+        # 排在前面的：所有批量请求（优先准入），以及 request_queue 中排在它前面的请求
+        queued_count = 0
+        queued_bytes = 0
+        for _, data_ids in self.batch_queue:
+            missing = [batch_id for batch_id in set(data_ids)
+                       if batch_id not in self.cache and not self.cache_order.check_exist(batch_id)]
+            queued_count += len(missing)
+            queued_bytes += sum(self._estimate_size_or_zero(batch_id) for batch_id in missing)
+        for queued_id, _ in self.request_queue.items():
+            if queued_id == data_id:
+                break
+            queued_count += 1
+            queued_bytes += self._estimate_size_or_zero(queued_id)
+
+        position = len(pending) + queued_count + 1
+        evictable = sum(
+            info['size'] for cached_id, info in self.cache.items()
+            if self.cache_order.check_exist(cached_id) and self.cache_order.get_weight(cached_id) == 0
+        )
+        pinned = self.cache_usage - evictable
+        if pinned + queued_bytes + own_size > self.cache_capacity:
+            return position, -1, True
+        return position, (pending_bytes + queued_bytes + own_size) / self.load_throughput, False
+
     def _get_file_size(self, file_path):
         return os.path.getsize(file_path)
     
-    def _ready_to_load(self, data_id):
+    def _ready_to_load(self, data_id, weight=1):
         # load_queue, cache_order, cache_usage 的更新紧耦合
         if not self.cache_order.check_exist(data_id):
-            # 如果是首次ready, 更新cache_usage，以原始文件大小预估
-            self.cache_usage += self._get_file_size(self._get_data_path(data_id))
+            # 如果是首次ready, 更新cache_usage，以预估大小占位
+            estimated_size = self._estimate_size(data_id)
+            self._pending_size[data_id] = estimated_size
+            self.cache_usage += estimated_size
             # 同时入队准备被load
             self.load_queue.put(data_id)
-        self.cache_order.increase(data_id)
+        self.cache_order.increase(data_id, weight)
 
         
     def _remove_data(self, data_id):
-        shm_name = self.cache[data_id]['shm_name']
-        shm = posix_ipc.SharedMemory(name=shm_name)
-        shm.unlink()
-        size_removed = shm.size
-        del self.cache[data_id]
-        self.cache_usage -= size_removed
-        self.cache_order.pop()
+        info = self.cache.pop(data_id)
+        self._unlink_entry(info)
+        self.cache_usage -= info['size']
+        self.cache_order.remove(data_id)
+
+        base_id = info.get('base')
+        if base_id in self.view_deps:
+            self.view_deps[base_id].discard(data_id)
+        # 基础表被淘汰时，依赖它且未被使用的视图一并淘汰；正在使用的视图保留，之后按权重正常淘汰
+        for view_id in self.view_deps.pop(data_id, set()):
+            if view_id in self.cache and self.cache_order.get_weight(view_id) == 0:
+                logger.info(f"[DataCache] removing view {view_id} with base {data_id}")
+                self._remove_data(view_id)
+        self._release_dictionaries()
     
+    def _fingerprint(self, data_id):
+        """源文件指纹 (mtime_ns, size, footer_hash)；文件不存在时返回 None"""
+        if self.fingerprint_mode == 'off':
+            return None
+        try:
+            st = os.stat(self._get_data_path(data_id))
+        except OSError:
+            return None
+        footer_hash = None
+        if self.fingerprint_mode == 'footer':
+            footer_hash = self._footer_hash(self._get_data_path(data_id))
+        return st.st_mtime_ns, st.st_size, footer_hash
+
+    def _footer_hash(self, data_path):
+        """parquet 文件末尾为 footer + 4 字节 footer 长度 + 'PAR1'，footer 含各列统计信息，足以区分内容变化"""
+        try:
+            with open(data_path, 'rb') as f:
+                f.seek(-8, os.SEEK_END)
+                tail = f.read(8)
+                footer_len = int.from_bytes(tail[:4], 'little')
+                f.seek(-8 - footer_len, os.SEEK_END)
+                return hashlib.md5(f.read(footer_len)).hexdigest()
+        except OSError:
+            return None
+
+    def _is_stale(self, data_id):
+        info = self.cache[data_id]
+        fingerprint = info.get('fingerprint')
+        if fingerprint is None:
+            return False
+        source_id = info.get('base', data_id)
+        try:
+            st = os.stat(self._get_data_path(source_id))
+        except OSError:
+            return False
+        if (st.st_mtime_ns, st.st_size) == fingerprint[:2]:
+            return False
+        if self.fingerprint_mode == 'footer' and fingerprint[2] is not None:
+            footer_hash = self._footer_hash(self._get_data_path(source_id))
+            if footer_hash == fingerprint[2]:
+                # 仅 mtime 变化，内容未变
+                info['fingerprint'] = (st.st_mtime_ns, st.st_size, footer_hash)
+                return False
+        return True
+
+    def _retire(self, data_id):
+        """
+        使 data_id 的当前段过期：从cache中移除并unlink，新的请求会重新加载；
+        仍在使用的客户端映射保持有效，其占用在客户端全部 COMPLETE 后才释放。依赖它的视图一并过期
+        """
+        info = self.cache.pop(data_id)
+        weight = self.cache_order.get_weight(data_id) if self.cache_order.check_exist(data_id) else 0
+        self.cache_order.remove(data_id)
+        self._unlink_entry(info)
+        # 只有已拿到段信息的客户端会使用旧段；其余引用（排队后尚未 CHECK 到、批量准入后尚未获取）只会拿到新版本
+        served = min(info.get('served', 0), weight)
+        if served > 0:
+            self.retired.setdefault(data_id, []).append({
+                'shm_name': info['shm_name'], 'size': info['size'], 'refs': served,
+                'dict_versions': info.get('dict_versions', {}),
+            })
+        else:
+            self.cache_usage -= info['size']
+        logger.info(f"[DataCache] {data_id} is stale, retired segment {info['shm_name']}")
+        if weight > served:
+            # 未拿到段信息的引用转为新版本的初始引用，并开始重新加载
+            self._ready_to_load(data_id, weight - served)
+
+        base_id = info.get('base')
+        if base_id in self.view_deps:
+            self.view_deps[base_id].discard(data_id)
+        for view_id in self.view_deps.pop(data_id, set()):
+            if view_id in self.cache:
+                self._retire(view_id)
+        self._release_dictionaries()
+
+    def _retire_if_stale(self, data_id):
+        """
+        源文件已更新时使 data_id 过期。视图的源文件是基础表的文件，此时基础表一并过期（依赖它的视图随之过期），
+        否则视图会用cache中旧的基础表重新计算
+        """
+        if data_id not in self.cache or not self._is_stale(data_id):
+            return
+        base_id = self.cache[data_id].get('base')
+        if base_id in self.cache:
+            self._retire(base_id)
+        if data_id in self.cache:
+            self._retire(data_id)
+
+    def _release_retired(self, data_id, shm_name):
+        """释放旧段上的一个引用，返回 shm_name 是否属于旧段"""
+        for record in self.retired.get(data_id, []):
+            if record['shm_name'] == shm_name:
+                record['refs'] -= 1
+                if record['refs'] == 0:
+                    self.cache_usage -= record['size']
+                    self.retired[data_id].remove(record)
+                    if not self.retired[data_id]:
+                        del self.retired[data_id]
+                    self._release_dictionaries()
+                return True
+        return False
+
+    def _on_file_changed(self, file_name):
+        """inotify 回调：data_path 下的文件被改写"""
+        if not file_name.endswith('s.parquet'):
+            return
+        data_id = file_name[:-len('s.parquet')]
+        with self._cache_lock:
+            if data_id in self.cache:
+                self._retire_if_stale(data_id)
+                self._manage_cache()
+
     # 所有的开放给server的接口都必须持有锁
 
-    def on_complete(self, data_id):
-        """客户端用完后，减少其在 cache_order 中的使用权重"""
+    def on_complete(self, data_id, shm_name=None):
+        """
+        客户端用完后，减少其在 cache_order 中的使用权重
+        :param shm_name: 客户端使用的段名；属于已过期的旧段时释放旧段的引用
+        """
         with self._cache_lock:
             logger.debug('lock_acquired in on_complete')
+            if shm_name is not None and self._release_retired(data_id, shm_name):
+                logger.debug(f"[DataCache] on_complete {data_id}, released retired segment {shm_name}.")
+                self._manage_cache()
+                return
             self.cache_order.decrease(data_id)
+            if data_id in self.cache:
+                info = self.cache[data_id]
+                info['served'] = max(info.get('served', 0) - 1, 0)
             logger.debug(f"[DataCache] on_complete {data_id}, decreased weight.")
             self._manage_cache()
 
-    def request_load(self, data_id):
+    def register_view(self, view_name, base_table, func):
+        """
+        对外开放接口
+        注册派生视图，视图的 data_id 为 f'{date}_{view_name}'；
+        func(array, columns) -> (result_array, result_columns)，应使用向量化 NumPy 实现
+        """
+        with self._cache_lock:
+            self.views[view_name] = (base_table, func)
+
+    def request_load(self, data_id, max_wait=None):
         """
         对外开放接口
         如果已经在cache里，就直接返回；若不在cache且有空间，就入load_queue；否则入request_queue等待；
+        :param max_wait: 只接受预计 max_wait 秒内能就绪的请求；预计不能就绪时不登记请求，返回 None
         """
         with self._cache_lock:
+            self.failed_loads.pop(data_id, None)
+            # 源文件已更新，旧段留给正在使用的客户端，本次请求按未缓存处理
+            self._retire_if_stale(data_id)
             if data_id in self.cache:
                 # 如果已经在cache里，直接返回
                 self.cache_order.increase(data_id)
                 return True
-            if self.cache_usage < self.cache_capacity or self.cache_order.check_exist(data_id):
-                # 如果还有空间或已经在cache_order中（被ready_load过），通过ready_load来更新cache_order
+            if max_wait is not None:
+                _, eta, overloaded = self._wait_estimate(data_id)
+                if overloaded or eta > max_wait:
+                    return None
+            if self.cache_order.check_exist(data_id) or \
+                    (self.cache_usage < self.cache_capacity and not self.batch_queue):
+                # 如果已经在cache_order中（被ready_load过），或还有空间且没有排队的批量请求，通过ready_load来更新cache_order
                 self._ready_to_load(data_id)
                 return True
             else:
-                # 没空间，没有ready_load过（第一次被请求），入request_queue
+                # 没空间或有批量请求在排队（空间留给队首的批量请求，避免其被单个请求饿死），入request_queue
                 logger.info(f"[DataCache] Not enough space, add {data_id} to request_queue.")
                 self.request_queue.increase(data_id)
                 self._manage_cache()
                 return False
 
+    def cancel_request(self, data_id):
+        """
+        对外开放接口
+        客户端放弃等待时撤销一次 REQUEST：排队中的减少等待数，加载中且没有其他请求的撤销加载，
+        已加载的同 on_complete；返回是否有可撤销的请求
+        """
+        with self._cache_lock:
+            if self.request_queue.check_exist(data_id):
+                if self.request_queue.get_weight(data_id) <= 1:
+                    self.request_queue.remove(data_id)
+                else:
+                    self.request_queue.increase(data_id, -1)
+                return True
+            if not self.cache_order.check_exist(data_id) or self.cache_order.get_weight(data_id) == 0:
+                return False
+            if data_id not in self.cache and self.cache_order.get_weight(data_id) == 1:
+                # 尚未加载完成，释放预估占位；加载线程取到它时会跳过
+                self.cache_order.remove(data_id)
+                self.cache_usage -= self._pending_size.pop(data_id, 0)
+            else:
+                self.cache_order.decrease(data_id)
+            logger.info(f"[DataCache] request for {data_id} cancelled")
+            self._manage_cache()
+            return True
+
+    def request_batch(self, data_ids):
+        """
+        对外开放接口
+        一个作业所需的全部数据整体准入：要么全部固定（引用各加一）并开始加载，要么整体排队，不会只固定一部分
+        :return: (True, None) 已准入；(False, ticket) 已排队，用 check_batch(ticket) 查询
+        """
+        data_ids = list(dict.fromkeys(data_ids))
+        with self._cache_lock:
+            for data_id in data_ids:
+                self.failed_loads.pop(data_id, None)
+                self._retire_if_stale(data_id)
+            ticket = next(self._batch_tickets)
+            if not self.batch_queue and self._batch_fits(data_ids):
+                self._admit_batch(ticket, data_ids)
+                self.admitted_batches.discard(ticket)
+                return True, None
+            logger.info(f"[DataCache] Not enough space, add batch {ticket} to batch_queue.")
+            self.batch_queue.append((ticket, data_ids))
+            self._manage_cache()
+            if ticket in self.admitted_batches:
+                self.admitted_batches.discard(ticket)
+                return True, None
+            return False, ticket
+
+    def check_batch(self, ticket):
+        """
+        对外开放接口
+        返回 'ADMITTED'（已准入，之后用 CHECK 逐个获取数据信息）、'WAIT' 或 'INVALID_REQUEST'
+        """
+        with self._cache_lock:
+            if ticket in self.admitted_batches:
+                self.admitted_batches.discard(ticket)
+                return 'ADMITTED'
+            if any(queued_ticket == ticket for queued_ticket, _ in self.batch_queue):
+                return 'WAIT'
+            return 'INVALID_REQUEST'
+
+    def invalidate(self, data_id):
+        """
+        对外开放接口
+        强制使 data_id 过期，下次请求时重新加载；返回是否存在该缓存
+        """
+        with self._cache_lock:
+            if data_id not in self.cache:
+                return False
+            self._retire(data_id)
+            self._manage_cache()
+            return True
+
+    def get_wait_info(self, data_id):
+        """
+        对外开放接口
+        返回 'WAIT|position|eta|overloaded'，各字段含义见 _wait_estimate
+        """
+        with self._cache_lock:
+            position, eta, overloaded = self._wait_estimate(data_id)
+        return f"WAIT|{position}|{eta:.1f}|{int(overloaded)}"
+
+    def get_load_error(self, data_id):
+        """
+        对外开放接口
+        返回最近一次加载 data_id 失败的错误信息，没有失败时返回 None
+        """
+        with self._cache_lock:
+            return self.failed_loads.get(data_id)
+
+    def get_data_size(self, data_id):
+        """
+        对外开放接口
+        返回数据占用的大小：已缓存时为实际大小，否则为预估大小；源文件不存在时为0
+        """
+        with self._cache_lock:
+            if data_id in self.cache:
+                return self.cache[data_id]['size']
+            try:
+                return self._estimate_size(data_id)
+            except OSError:
+                return 0
+
     def get_cache_info(self, data_id):
         """
-        返回 shm_name|shape|dtype
+        返回 shm_name|shape|dtype|columns|dictionaries|time_index，并记一次段信息已交给持有引用的客户端（见 _retire）
+        dictionaries 为 'column@shm_name@dtype@length' 以 ';' 连接，length 为该数据可能用到的编码数
+        time_index 为 'index_shm@n_rows@n_stocks@stock_col@time_col'，没有索引时为空
+        """
+        with self._cache_lock:
+            if data_id not in self.cache:
+                return None
+            info = self.cache[data_id]
+            info['served'] = info.get('served', 0) + 1
+            dicts = ';'.join(
+                f"{col}@{shm_name}@{dtype}@{length}"
+                for col, (shm_name, dtype, length) in info.get('dict_versions', {}).items()
+            )
+            time_index = ''
+            if 'index_shm' in info:
+                stock_col, time_col = info['sort_keys']
+                time_index = f"{info['index_shm']}@{info['index_shape'][0]}@{info['n_stocks']}@{stock_col}@{time_col}"
+            return (f"{info['shm_name']}|{info['shape']}|{info['dtype']}|{','.join(info['columns'])}"
+                    f"|{dicts}|{time_index}")
+
+    def get_segment(self, data_id):
+        """
+        返回 (shm_name, shape, dtype, columns, nbytes, dicts)，供 FETCH 传输原始字节；未缓存时返回 None
+        dicts 为 {column: 字典值列表}
         """
         with self._cache_lock:
             if data_id not in self.cache:
                 return None
             info = self.cache[data_id]
-            return f"{info['shm_name']}|{info['shape']}|{info['dtype']}"
+            nbytes = int(np.prod(info['shape'])) * info['dtype'].itemsize
+            dicts = {
+                col: [str(value) for value in self.dictionaries[(info['table'], col)]['values']]
+                for col in info.get('dict_columns', [])
+            }
+            return info['shm_name'], info['shape'], info['dtype'], info['columns'], nbytes, dicts
 
     def exit_and_clean(self):
         """退出前的清理"""
         self._stop_event.set()
         self.loader_thread.join(timeout=3)
+        self.fetch_pool.shutdown(wait=False)
+        if self.watcher is not None:
+            self.watcher.stop()
 
         with self._cache_lock:
             while not self.cache_order.empty():
                 least_used_key, _ = self.cache_order.front()
-                shm_name = self.cache[least_used_key]['shm_name']
-                shm = posix_ipc.SharedMemory(name=shm_name)
-                shm.unlink()
+                self._unlink_entry(self.cache[least_used_key])
                 self.cache_order.pop()
+            for entry in self.dictionaries.values():
+                shm_utils.unlink_segment(entry['shm_name'])
+            for shm_name in self.old_dictionaries:
+                shm_utils.unlink_segment(shm_name)
         os._exit(0)
@@ -1,74 +1,234 @@
+import os
 import socket
 import time
+import threading
 import numpy as np
-import pandas as pd
-import posix_ipc
-import mmap
 import logging
 import sys
 
+from cluster import HashRing, placement_key, parse_node, is_local_host, fetch_array, recv_all
+import shm_utils
+
+# pandas 导入较慢，只在需要返回 DataFrame 时才导入，见 _pandas()
+pd = None
+
 logger = logging.getLogger('loader_logger')
 logger.setLevel(logging.DEBUG) 
 
-file_handler = logging.FileHandler('date_loader.log')
-file_handler.setLevel(logging.DEBUG)  
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-
+# 导入时不创建日志文件（每个短任务进程都会导入本模块），文件日志需显式开启，见 enable_file_logging()
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.INFO)  
 console_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console_handler.setFormatter(console_formatter)
 
-logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
+
+def enable_file_logging(log_file='date_loader.log'):
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setLevel(logging.DEBUG)
+    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler.setFormatter(file_formatter)
+    logger.addHandler(file_handler)
+
+
+def _pandas():
+    global pd
+    if pd is None:
+        import pandas
+        pd = pandas
+    return pd
+
+
+class _SegmentRegistry:
+    """
+    进程级共享的注册表，跨 DataLoader 实例复用：
+    - segments: data_id -> 已映射的共享内存及本进程内的引用数。同一进程内只向服务端 REQUEST/COMPLETE 各一次
+    - rings: 节点列表 -> HashRing，避免每个实例重建哈希环
+    - categories: 字典段名 -> pandas Index，每个字典版本在每个进程中只构建一次
+    fork 后子进程清空注册表：父进程持有的服务端引用由父进程释放，子进程需要时重新请求
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.rings = {}
+        self.categories = {}
+
+    def get_ring(self, cluster_nodes):
+        key = tuple(cluster_nodes)
+        with self.lock:
+            if key not in self.rings:
+                self.rings[key] = HashRing(cluster_nodes)
+            return self.rings[key]
+
+
+_registry = _SegmentRegistry()
+os.register_at_fork(after_in_child=_registry.reset)
+
+
 class DataLoader:
-    def __init__(self, host='localhost', port=6000):
+    def __init__(self, host='localhost', port=6000, cluster_nodes=None, populate=False, advice=None,
+                 max_wait=None, fail_fast=False):
+        """
+        :param host, port: 本机缓存节点
+        :param cluster_nodes: 集群模式下的节点列表（'host:port'），需与各节点配置一致
+        :param populate: 映射时 MAP_POPULATE 预建页表，适合随后要全量扫描的数据
+        :param advice: 映射的读取模式提示，'sequential' / 'random' / 'willneed'
+        :param max_wait: 默认只获取预计 max_wait 秒内能就绪的数据，否则返回 None；可在 load_day/fetch 中单独指定
+        :param fail_fast: 服务端过载（内存被正在使用的数据占满）时立即放弃，而不是等待其他客户端释放
+        """
         self.host = host
         self.port = port
+        self.ring = _registry.get_ring(cluster_nodes) if cluster_nodes else None
         self.request_timeout = 60*60
+        # 轮询间隔按服务端估计的就绪时间调整，在 [min_poll_interval, poll_interval] 之间
         self.poll_interval = 30
+        self.min_poll_interval = 1
+        self.max_wait = max_wait
+        self.fail_fast = fail_fast
         self.requested_data = []
+        self.populate = populate
+        self.advice = advice
     
     def __del__(self):
-        print("DataLoader is being deleted.")
-        for data_id in self.requested_data:
+        # fork 继承来的引用不在子进程的注册表中，finish_using 会跳过它们
+        for data_id in list(self.requested_data):
             self.finish_using(data_id)
     
     def _parse_info(self, info):
-        shm_name, shape_str, dtype_str = info.split('|')
-        shape = tuple(map(int, shape_str[1:-1].split(',')))
+        shm_name, shape_str, dtype_str, columns_str, dicts_str, index_str = info.split('|')
+        shape = tuple(int(dim) for dim in shape_str[1:-1].split(',') if dim.strip())
         dtype = np.dtype(dtype_str)
-        return shm_name, shape, dtype
-        
+        columns = columns_str.split(',') if columns_str else None
+        # 字典编码列: [(column, dict_shm_name, dict_dtype, length)]
+        dicts = []
+        for item in filter(None, dicts_str.split(';')):
+            col, dict_shm_name, dict_dtype, length = item.split('@')
+            dicts.append((col, dict_shm_name, np.dtype(dict_dtype), int(length)))
+        # 时间索引: (index_shm, n_rows, n_stocks, stock_col, time_col)，没有时为 None
+        time_index = None
+        if index_str:
+            index_shm, n_rows, n_stocks, stock_col, time_col = index_str.split('@')
+            time_index = (index_shm, int(n_rows), int(n_stocks), stock_col, time_col)
+        return shm_name, shape, dtype, columns, dicts, time_index
 
-    def request_data(self, data_id):
+    def _categories(self, dict_shm_name, dict_dtype, length):
+        """读取共享字典段，构建 Categorical 使用的 categories（每个进程每个字典版本只构建一次）"""
+        with _registry.lock:
+            categories = _registry.categories.get(dict_shm_name)
+        if categories is None:
+            fd, size = shm_utils.open_segment(dict_shm_name)
+            try:
+                shm_mmap = shm_utils.map_segment(fd, size)
+            finally:
+                os.close(fd)
+            values = np.ndarray((length,), dtype=dict_dtype, buffer=shm_mmap)
+            categories = _pandas().Index(values)
+            del values
+            shm_mmap.close()
+            with _registry.lock:
+                _registry.categories[dict_shm_name] = categories
+        return categories[:length]
+
+    def _route(self, data_id):
+        """
+        返回处理 data_id 的节点地址：owner 在本机时直接访问 owner，
+        否则访问本机节点，由其从 owner 拉取并缓存（读穿 L2）
+        """
+        if self.ring is None:
+            return self.host, self.port
+        host, port = parse_node(self.ring.get_node(placement_key(data_id)))
+        if is_local_host(host):
+            return host, port
+        return self.host, self.port
+
+
+    def request_data(self, data_id, max_wait=None):
+        """
+        :param max_wait: 只获取预计 max_wait 秒内能就绪的数据，为 None 时使用 self.max_wait
+        :return: 数据信息；不可用、超时或放弃时返回 None
+        """
+        if max_wait is None:
+            max_wait = self.max_wait
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((self.host, self.port))
-        client_socket.send(f"REQUEST#{data_id}".encode())
-        info = client_socket.recv(1024).decode()
+        client_socket.connect(self._route(data_id))
+        command = f"REQUEST#{data_id}" if max_wait is None else f"REQUEST#{data_id}#{max_wait}"
+        client_socket.send(command.encode())
+        info = recv_all(client_socket)
         client_socket.close()
+        if info.startswith("UNAVAILABLE"):
+            # 服务端没有登记本次请求，无需撤销
+            position, eta, overloaded = self._parse_wait(info)
+            logger.info(f"{data_id} is not expected to be ready within {max_wait}s "
+                        f"(position {position}, eta {eta}s, overloaded {overloaded})")
+            return None
         if not info.startswith("WAIT"):
             return self._parse_info(info)
-        return self._poll_result(data_id, time.time())
-        
-    def _poll_result(self, data_id: str, start_time: float):
+        return self._poll_result(data_id, time.time(), info, max_wait)
+
+    def _parse_wait(self, response):
+        """解析 'WAIT|position|eta|overloaded'，返回 (position, eta, overloaded)，eta 未知时为 -1"""
+        parts = response.split('|')
+        if len(parts) < 4:
+            return None, -1, False
+        return int(parts[1]), float(parts[2]), parts[3] == '1'
+
+    def _backoff(self, eta, attempt, remaining):
+        """
+        下次轮询前的等待时间：有就绪时间估计时按估计等待，否则指数退避；
+        不超过 poll_interval，以便及时拿到更新的估计，也不超过剩余的等待时间
+        """
+        if eta >= 0:
+            interval = max(eta, self.min_poll_interval)
+        else:
+            interval = self.min_poll_interval * 2 ** attempt
+        return max(0, min(interval, self.poll_interval, remaining))
+
+    def _cancel(self, data_id):
+        """放弃等待，撤销服务端登记的请求，避免数据就绪后一直被占用"""
+        try:
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.connect(self._route(data_id))
+            client_socket.send(f"CANCEL#{data_id}".encode())
+            client_socket.recv(1024)
+            client_socket.close()
+        except socket.error as e:
+            logger.error(f"Error cancelling request for {data_id}: {e}")
+
+    def _poll_result(self, data_id: str, start_time: float, response=None, max_wait=None):
+        """
+        轮询直到数据就绪
+        :param response: 最近一次的 WAIT 响应；为 None 时（例如批量准入后）立即 CHECK，不先等待
+        :param max_wait: 等待上限（秒），为 None 时为 request_timeout；超时后撤销请求
+        """
+        timeout = self.request_timeout if max_wait is None else max_wait
+        attempt = 0
         while True:
-            if time.time() - start_time > self.request_timeout:
-                logger.error(f"Request timeout for {data_id}")
-                return None
+            if response is not None:
+                _, eta, overloaded = self._parse_wait(response)
+                if overloaded and self.fail_fast:
+                    logger.warning(f"Server overloaded, giving up on {data_id}")
+                    self._cancel(data_id)
+                    return None
+                remaining = timeout - (time.time() - start_time)
+                if remaining < 0:
+                    logger.error(f"Request timeout for {data_id}")
+                    self._cancel(data_id)
+                    return None
+                time.sleep(self._backoff(eta, attempt, remaining))
+                attempt += 1
             try:
                 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.connect((self.host, self.port))
+                client_socket.connect(self._route(data_id))
                 if not client_socket:
-                    time.sleep(self.poll_interval)
                     continue
                 client_socket.send(f"CHECK#{data_id}".encode())
-                response = client_socket.recv(1024).decode()
+                response = recv_all(client_socket)
                 client_socket.close()
-                if response == "WAIT":
-                    time.sleep(self.poll_interval)
+                if response.startswith("WAIT"):
                     continue
                 elif response == "INVALID_REQUEST":
                     logger.error(f"Invalid request for {data_id}")
@@ -77,35 +237,246 @@ class DataLoader:
                     return self._parse_info(response)
             except socket.error as e:
                 logger.error(f"Error checking request for {data_id}: {e}")
-                time.sleep(self.poll_interval)
+                response = "WAIT"
                 continue
 
-    def notify_completion(self, data_id):
-        print(f"Sending completion notification for {data_id}")
+    def notify_completion(self, data_id, shm_name=None):
+        """
+        :param shm_name: 使用的段名，数据在使用期间被更新时服务端据此释放旧段
+        """
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((self.host, self.port))
-        client_socket.send(f"COMPLETE#{data_id}".encode())
+        client_socket.connect(self._route(data_id))
+        command = f"COMPLETE#{data_id}" if shm_name is None else f"COMPLETE#{data_id}#{shm_name}"
+        client_socket.send(command.encode())
         ack = client_socket.recv(1024).decode()
         if ack == "ACK":
             logger.info(f"Completion notification for {data_id} sent successfully.")
         client_socket.close()
-        print(f"Completion notification for {data_id} sent successfully.")
 
-    def load_day(self, table, date):
+    def fetch(self, table, date, rows=None, columns=None, out=None, max_wait=None):
+        """
+        通过 FETCH 把数据拷贝到本进程，用于节点不在本机、无法映射共享内存的情况
+        :param rows: (start, stop) 行区间
+        :param columns: 列名列表
+        :param out: 预分配的接收数组
+        :param max_wait: 只获取预计 max_wait 秒内能就绪的数据，否则返回 None
+        :return: (array, columns, dicts)，字典编码列为整数编码，dicts 为 {列名: 字典值列表}
+        """
         data_id = f'{date}_{table}'
-        shm_name, shape, dtype = self.request_data(data_id)
-        print(shm_name, shape, dtype)
+        info = self.request_data(data_id, max_wait)
+        if info is None:
+            return None
+        host, port = self._route(data_id)
+        try:
+            return fetch_array(host, port, data_id, rows=rows, columns=columns, out=out)
+        finally:
+            # 数据已拷贝到本地，立即释放服务端引用
+            self.notify_completion(data_id, info[0])
+
+    def load_day(self, table, date, max_wait=None):
+        """
+        :param max_wait: 只获取预计 max_wait 秒内能就绪的数据，否则返回 None；
+                         为 0 时只获取已在缓存中的数据，调度器可据此优先处理已驻留的数据
+        """
+        data_id = f'{date}_{table}'
+        host, _ = self._route(data_id)
+        if not is_local_host(host):
+            fetched = self.fetch(table, date, max_wait=max_wait)
+            if fetched is None:
+                return None
+            array, columns, dicts = fetched
+            categories = {col: _pandas().Index(values) for col, values in dicts.items()}
+            return self._to_frame(array, columns, categories)
 
         try:
-            shm = posix_ipc.SharedMemory(name=shm_name)
-            shm_mmap = mmap.mmap(shm.fd, shm.size, access=mmap.ACCESS_READ)
-            shm_arr = np.ndarray(shape, dtype=dtype, buffer=shm_mmap)
-            df = pd.DataFrame(shm_arr)
-            self.requested_data.append(data_id)
-            return df
+            shm_arr, columns, categories = self._attach(data_id, max_wait)
         except Exception as e:
             logger.error(f"Error loading data {data_id}: {e}")
+            return None
+        return self._to_frame(shm_arr, columns, categories)
+
+    def _to_frame(self, array, columns, categories):
+        """构建 DataFrame，字典编码列还原为 Categorical（只拷贝编码列本身，字典在进程内共享）"""
+        pd = _pandas()
+        df = pd.DataFrame(array, columns=columns, copy=False)
+        for col, col_categories in categories.items():
+            codes = df[col].to_numpy().astype(np.int32)
+            df[col] = pd.Categorical.from_codes(codes, categories=col_categories)
+        return df
+
+    def _attach(self, data_id, max_wait=None):
+        """
+        映射 data_id 对应的共享内存，返回 (array, columns, categories)
+        同一进程内已映射过的数据直接复用，不再访问服务端；进程持有期间看到的是首次映射时的版本
+        """
+        with _registry.lock:
+            segment = _registry.segments.get(data_id)
+            if segment is not None:
+                segment['refs'] += 1
+                self.requested_data.append(data_id)
+                return segment['array'], segment['columns'], segment['categories']
+
+        info = self.request_data(data_id, max_wait)
+        if info is None:
+            raise RuntimeError(f"data {data_id} is not available")
+        return self._map(data_id, info)
+
+    def _map(self, data_id, info):
+        """映射服务端已为本进程固定的数据并登记到注册表"""
+        shm_name, shape, dtype, columns, dicts, time_index = info
+        categories = {col: self._categories(*dict_info) for col, *dict_info in dicts}
+        index = self._map_index(time_index) if time_index is not None else None
+        fd, size = shm_utils.open_segment(shm_name)
+        try:
+            shm_mmap = shm_utils.map_segment(fd, size, populate=self.populate, advice=self.advice)
+        finally:
+            os.close(fd)
+        shm_arr = np.ndarray(shape, dtype=dtype, buffer=shm_mmap)
+
+        duplicated = False
+        with _registry.lock:
+            segment = _registry.segments.get(data_id)
+            if segment is None:
+                _registry.segments[data_id] = {
+                    'array': shm_arr, 'columns': columns, 'categories': categories, 'index': index,
+                    'shm_name': shm_name, 'refs': 1
+                }
+            else:
+                # 其他线程同时完成了映射，复用其结果并释放本次多出的服务端引用
+                segment['refs'] += 1
+                shm_arr, columns, categories = segment['array'], segment['columns'], segment['categories']
+                duplicated = True
+            self.requested_data.append(data_id)
+        if duplicated:
+            self.notify_completion(data_id, shm_name)
+        return shm_arr, columns, categories
     
+    def _map_index(self, time_index):
+        """映射时间索引段，返回 {'stocks': (n_stocks, 3), 'samples': (n_samples, 3), 'stock_col', 'time_col'}"""
+        index_shm, n_rows, n_stocks, stock_col, time_col = time_index
+        fd, size = shm_utils.open_segment(index_shm)
+        try:
+            shm_mmap = shm_utils.map_segment(fd, size)
+        finally:
+            os.close(fd)
+        index = np.ndarray((n_rows, 3), dtype=np.float64, buffer=shm_mmap)
+        return {'stocks': index[:n_stocks], 'samples': index[n_stocks:], 'stock_col': stock_col, 'time_col': time_col}
+
+    def slice(self, table, date, stock, t0, t1, stock_col='stock_code', time_col=None):
+        """
+        返回某只股票在时间窗口 [t0, t1) 内的数据
+        服务端发布了时间索引时，按股票行区间 + 稀疏采样二分查找，返回共享内存上的零拷贝视图（列名取自索引）；
+        否则退回全表筛选，此时需要给出 time_col
+        """
+        data_id = f'{date}_{table}'
+        host, _ = self._route(data_id)
+        if not is_local_host(host):
+            return self._filter_slice(self.load_day(table, date), stock, t0, t1, stock_col, time_col)
+
+        shm_arr, columns, categories = self._attach(data_id)
+        with _registry.lock:
+            index = _registry.segments[data_id]['index']
+        if index is None:
+            df = self._to_frame(shm_arr, columns, categories)
+            return self._filter_slice(df, stock, t0, t1, stock_col, time_col)
+
+        stock_col, time_col = index['stock_col'], index['time_col']
+        if stock_col in categories:
+            if stock not in categories[stock_col]:
+                return self._to_frame(shm_arr[:0], columns, categories)
+            stock_key = categories[stock_col].get_loc(stock)
+        else:
+            stock_key = float(stock)
+
+        stocks = index['stocks']
+        i = np.searchsorted(stocks[:, 0], stock_key)
+        if i == len(stocks) or stocks[i, 0] != stock_key:
+            return self._to_frame(shm_arr[:0], columns, categories)
+        start, end = int(stocks[i, 1]), int(stocks[i, 2])
+        times = shm_arr[:, columns.index(time_col)]
+        lo = self._lower_bound(times, index['samples'], start, end, t0)
+        hi = self._lower_bound(times, index['samples'], start, end, t1)
+        return self._to_frame(shm_arr[lo:hi], columns, categories)
+
+    @staticmethod
+    def _lower_bound(times, samples, start, end, t):
+        """在 [start, end) 行内找第一个时间 >= t 的行：先在稀疏采样上二分定位块，再在块内二分"""
+        sample_rows = samples[:, 1]
+        k0 = np.searchsorted(sample_rows, start)
+        k1 = np.searchsorted(sample_rows, end)
+        j = k0 + np.searchsorted(samples[k0:k1, 0], t)
+        lo = int(sample_rows[j - 1]) if j > k0 else start
+        hi = int(sample_rows[j]) if j < k1 else end
+        return lo + int(np.searchsorted(times[lo:hi], t))
+
+    def _filter_slice(self, df, stock, t0, t1, stock_col, time_col):
+        if time_col is None:
+            raise ValueError("time_col is required when the server publishes no time index")
+        return df[(df[stock_col] == stock) & (df[time_col] >= t0) & (df[time_col] < t1)]
+
+    def load_batch(self, requests):
+        """
+        一次性请求一个作业需要的全部数据（例如同一天的 trade/order/tick），服务端整体准入，
+        避免内存紧张时只拿到部分数据而占着它们等待其余数据
+        :param requests: [(table, date), ...]
+        :return: {(table, date): DataFrame}
+        """
+        data_ids = [f'{date}_{table}' for table, date in requests]
+        if not all(is_local_host(self._route(data_id)[0]) for data_id in data_ids):
+            # 远程读取是拷贝，读完即释放，不存在部分固定的问题
+            return {(table, date): self.load_day(table, date) for table, date in requests}
+        with _registry.lock:
+            mapped = {data_id for data_id in data_ids if data_id in _registry.segments}
+        to_request = [data_id for data_id in dict.fromkeys(data_ids) if data_id not in mapped]
+
+        # 按节点分组，每个节点一个批量请求（集群模式下按日期放置，同一天的数据在同一节点）
+        by_node = {}
+        for data_id in to_request:
+            by_node.setdefault(self._route(data_id), []).append(data_id)
+        admitted = []
+        for address, node_data_ids in by_node.items():
+            if not self._request_batch(address, node_data_ids):
+                # 撤销已在其他节点准入的数据，避免它们一直被固定
+                for data_id in admitted:
+                    self._cancel(data_id)
+                raise RuntimeError(f"batch {node_data_ids} is not available")
+            admitted.extend(node_data_ids)
+
+        result = {}
+        for (table, date), data_id in zip(requests, data_ids):
+            if data_id in to_request:
+                info = self._poll_result(data_id, time.time())
+                if info is None:
+                    raise RuntimeError(f"data {data_id} is not available")
+                shm_arr, columns, categories = self._map(data_id, info)
+                to_request.remove(data_id)
+            else:
+                shm_arr, columns, categories = self._attach(data_id)
+            result[(table, date)] = self._to_frame(shm_arr, columns, categories)
+        return result
+
+    def _request_batch(self, address, data_ids):
+        """发送批量请求并等待整体准入；准入后各数据已被固定，用 CHECK 获取信息"""
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect(address)
+        client_socket.send(f"BATCH#{','.join(data_ids)}".encode())
+        response = client_socket.recv(1024).decode()
+        client_socket.close()
+        start_time = time.time()
+        while response.startswith("WAIT"):
+            if time.time() - start_time > self.request_timeout:
+                logger.error(f"Batch request timeout for {data_ids}")
+                return False
+            time.sleep(self.poll_interval)
+            ticket = response.split('#', 1)[1]
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.connect(address)
+            client_socket.send(f"BATCH_CHECK#{ticket}".encode())
+            status = client_socket.recv(1024).decode()
+            client_socket.close()
+            response = f"WAIT#{ticket}" if status == "WAIT" else status
+        return response == "ADMITTED"
+
     def load_stock(self, table, date, stock):
         df = self.load_day(table, date)
         return df[df['stock_id'] == stock]
@@ -121,4 +492,16 @@ class DataLoader:
             return res
 
     def finish_using(self, data_id):
-        self.notify_completion(data_id)
\ No newline at end of file
+        if data_id not in self.requested_data:
+            return
+        self.requested_data.remove(data_id)
+        with _registry.lock:
+            segment = _registry.segments.get(data_id)
+            if segment is None:
+                return
+            segment['refs'] -= 1
+            if segment['refs'] > 0:
+                return
+            # 映射随引用它的 DataFrame 一起回收
+            del _registry.segments[data_id]
+        self.notify_completion(data_id, segment['shm_name'])
\ No newline at end of file
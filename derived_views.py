@@ -0,0 +1,115 @@
+"""
+服务端派生视图：在已缓存的基础表上用向量化 NumPy 计算常用聚合，
+结果作为独立的共享内存数据缓存，客户端像普通 data_id 一样请求，
+例如 '20231226_trade_vwap'。
+
+视图函数签名：func(array, columns) -> (result_array, result_columns)
+- array: 基础表的二维数组（共享内存中的只读视图，不要原地修改）
+- columns: 基础表的列名列表
+"""
+
+import numpy as np
+
+STOCK_COL = 'stock_code'
+TRADE_TIME_COL = 'TradeTime'
+TRADE_PRICE_COL = 'TradePrice'
+TRADE_VOLUME_COL = 'TradeVolume'
+
+# TradeTime 形如 HHMMSSmmm，整除该值得到 HHMM 分钟桶
+MINUTE_DIVISOR = 100000
+
+
+def _col(array, columns, name):
+    return array[:, columns.index(name)].astype(np.float64, copy=False)
+
+
+def _minute_bucket(times):
+    return np.floor_divide(times, MINUTE_DIVISOR)
+
+
+def vwap(array, columns):
+    """逐股票全天成交量加权均价: stock_code, vwap, volume, amount"""
+    stock = _col(array, columns, STOCK_COL)
+    price = _col(array, columns, TRADE_PRICE_COL)
+    volume = _col(array, columns, TRADE_VOLUME_COL)
+
+    stocks, inverse = np.unique(stock, return_inverse=True)
+    total_volume = np.bincount(inverse, weights=volume, minlength=len(stocks))
+    total_amount = np.bincount(inverse, weights=price * volume, minlength=len(stocks))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vwap_price = np.where(total_volume > 0, total_amount / total_volume, np.nan)
+
+    result = np.column_stack([stocks, vwap_price, total_volume, total_amount])
+    return result, [STOCK_COL, 'vwap', 'volume', 'amount']
+
+
+def _group_by_stock_minute(array, columns):
+    """
+    按 (stock_code, minute, TradeTime) 排序后返回排序索引、分组起点和分组键
+    """
+    stock = _col(array, columns, STOCK_COL)
+    times = _col(array, columns, TRADE_TIME_COL)
+    minute = _minute_bucket(times)
+
+    order = np.lexsort((times, minute, stock))
+    stock_sorted = stock[order]
+    minute_sorted = minute[order]
+
+    if len(order) == 0:
+        starts = np.empty(0, dtype=np.intp)
+    else:
+        boundary = np.empty(len(order), dtype=bool)
+        boundary[0] = True
+        boundary[1:] = (stock_sorted[1:] != stock_sorted[:-1]) | (minute_sorted[1:] != minute_sorted[:-1])
+        starts = np.flatnonzero(boundary)
+    return order, starts, stock_sorted[starts], minute_sorted[starts]
+
+
+def ohlc_1min(array, columns):
+    """逐股票 1 分钟 K 线: stock_code, minute, open, high, low, close, volume"""
+    order, starts, stocks, minutes = _group_by_stock_minute(array, columns)
+    names = [STOCK_COL, 'minute', 'open', 'high', 'low', 'close', 'volume']
+    if len(starts) == 0:
+        return np.empty((0, len(names)), dtype=np.float64), names
+
+    price = _col(array, columns, TRADE_PRICE_COL)[order]
+    volume = _col(array, columns, TRADE_VOLUME_COL)[order]
+    ends = np.append(starts[1:], len(order)) - 1
+
+    result = np.column_stack([
+        stocks,
+        minutes,
+        price[starts],
+        np.maximum.reduceat(price, starts),
+        np.minimum.reduceat(price, starts),
+        price[ends],
+        np.add.reduceat(volume, starts),
+    ])
+    return result, names
+
+
+def volume_1min(array, columns):
+    """逐股票每分钟成交量与成交额: stock_code, minute, volume, amount"""
+    order, starts, stocks, minutes = _group_by_stock_minute(array, columns)
+    names = [STOCK_COL, 'minute', 'volume', 'amount']
+    if len(starts) == 0:
+        return np.empty((0, len(names)), dtype=np.float64), names
+
+    price = _col(array, columns, TRADE_PRICE_COL)[order]
+    volume = _col(array, columns, TRADE_VOLUME_COL)[order]
+
+    result = np.column_stack([
+        stocks,
+        minutes,
+        np.add.reduceat(volume, starts),
+        np.add.reduceat(price * volume, starts),
+    ])
+    return result, names
+
+
+# 视图名 -> (基础表, 视图函数)；视图的 data_id 为 f'{date}_{视图名}'
+DEFAULT_VIEWS = {
+    'trade_vwap': ('trade', vwap),
+    'trade_ohlc1m': ('trade', ohlc_1min),
+    'trade_vol1m': ('trade', volume_1min),
+}
@@ -0,0 +1,85 @@
+"""
+基于 inotify 的目录监听（通过 ctypes 调用 libc，无额外依赖）。
+只在 Linux 本地文件系统上有效；不可用时 start() 返回 False，由调用方退回按需检查。
+"""
+
+import ctypes
+import logging
+import os
+import select
+import struct
+import threading
+
+logger = logging.getLogger('cache_logger')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    def __init__(self, path, callback):
+        """
+        :param path: 监听的目录
+        :param callback: callback(file_name)，目录下有文件被写完或被移入（原子替换）时调用
+        """
+        self.path = path
+        self.callback = callback
+        self._fd = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO
+            if libc.inotify_add_watch(fd, os.fsencode(self.path), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable for {self.path}: {e}")
+            return False
+        self._fd = fd
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        logger.info(f"Watching {self.path} for changes")
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=3)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 1)
+            if not readable:
+                continue
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            for file_name in self._parse_events(buf):
+                try:
+                    self.callback(file_name)
+                except Exception as e:
+                    logger.error(f"Error handling change of {file_name}: {e}")
+
+    @staticmethod
+    def _parse_events(buf):
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            _, _, _, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if name:
+                yield os.fsdecode(name)
@@ -33,15 +33,11 @@ class PriorityQueue:
         # print('decrease_called')
         if key not in self.entry_finder:
             self._add_entry(key, 0)
-        entry = self.entry_finder[key]
-        weight, counter, key = entry
-        if self.min_queue:
-            if weight == 0:
-                raise ValueError("Weight cannot go below 0")
-            new_weight = weight - 1
-        else:
-            new_weight = weight + 1
-        # 更新权重并重新加入堆
+        weight = self.get_weight(key)
+        if self.min_queue and weight == 0:
+            raise ValueError("Weight cannot go below 0")
+        new_weight = weight - 1
+        # 更新权重并重新加入堆（_add_entry 接收实际权重）
         self._remove_entry(key)
         self._add_entry(key, new_weight)
         # print('decrease_finished')
@@ -50,13 +46,8 @@ class PriorityQueue:
         """权重增加指定值"""
         if key not in self.entry_finder:
             self._add_entry(key, 0)
-        entry = self.entry_finder[key]
-        weight, counter, key = entry
-        if self.min_queue:
-            new_weight = weight + optional_weight
-        else:
-            new_weight = weight - optional_weight
-        # 更新权重并重新加入堆
+        new_weight = self.get_weight(key) + optional_weight
+        # 更新权重并重新加入堆（_add_entry 接收实际权重）
         self._remove_entry(key)
         self._add_entry(key, new_weight)
 
@@ -79,6 +70,23 @@ class PriorityQueue:
                 heapq.heappop(self.heap)
         raise KeyError('getmin from an empty priority queue')
 
+    def remove(self, key):
+        """删除指定键"""
+        if key in self.entry_finder:
+            self._remove_entry(key)
+
+    def items(self):
+        """按出队顺序返回 [(键, 权重)]"""
+        return [
+            (key, weight if self.min_queue else -weight)
+            for weight, counter, key in sorted(self.entry_finder.values())
+        ]
+
+    def get_weight(self, key):
+        """返回指定键的权重"""
+        weight = self.entry_finder[key][0]
+        return weight if self.min_queue else -weight
+
     def __contains__(self, key):
         """检查键是否存在"""
         return key in self.entry_finder and self.entry_finder[key][-1] is not self.REMOVED
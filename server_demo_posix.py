@@ -1,8 +1,18 @@
+import json
+import sys
 
 from cache_server import CacheServer
 from data_cache_new import DataCache
 
 if __name__ == '__main__':
-    loader = DataCache(config_file='config.json')
-    server = CacheServer(data_cache=loader)
+    # 同一台机器上启动多个节点：python server_demo_posix.py node1.json
+    config_file = sys.argv[1] if len(sys.argv) > 1 else 'config.json'
+    config = json.load(open(config_file))
+    loader = DataCache(config_file=config_file)
+    server = CacheServer(
+        data_cache=loader,
+        host=config.get('host', 'localhost'),
+        port=config.get('port', 6000),
+        trace_file=config.get('trace_file')
+    )
     server.start()
\ No newline at end of file
@@ -0,0 +1,199 @@
+"""
+共享内存段的创建、映射与删除。
+
+段名有两种形式：
+- POSIX 共享内存名，如 '/shm_20231226_trade'（位于 /dev/shm，普通 4K 页）
+- hugetlbfs 挂载点下的文件路径，如 '/dev/hugepages/shm_20231226_trade'（大页）
+客户端和服务端都通过本模块打开段，无需关心具体形式。
+
+大页与 NUMA 相关选项在大页未配置、内核不支持或非 Linux 时自动退回普通页，不影响正确性。
+"""
+
+import ctypes
+import logging
+import mmap
+import os
+import platform
+
+import posix_ipc
+
+logger = logging.getLogger('cache_logger')
+
+DEFAULT_HUGETLBFS_PATH = '/dev/hugepages'
+
+# 以下常量在部分 Python 版本的 mmap 模块中没有导出
+MADV_HUGEPAGE = getattr(mmap, 'MADV_HUGEPAGE', 14)
+MAP_POPULATE = getattr(mmap, 'MAP_POPULATE', 0x8000)
+
+MPOL_BIND = 2
+MPOL_INTERLEAVE = 3
+_SYS_MBIND = {'x86_64': 237, 'aarch64': 235}
+
+_ADVICE = {
+    'normal': getattr(mmap, 'MADV_NORMAL', None),
+    'sequential': getattr(mmap, 'MADV_SEQUENTIAL', None),
+    'random': getattr(mmap, 'MADV_RANDOM', None),
+    'willneed': getattr(mmap, 'MADV_WILLNEED', None),
+}
+
+
+def is_hugetlbfs_segment(seg_name):
+    # POSIX 共享内存名只有开头一个 '/'
+    return '/' in seg_name[1:]
+
+
+def _huge_page_size(hugetlbfs_path):
+    return os.statvfs(hugetlbfs_path).f_bsize
+
+
+def _round_up(size, unit):
+    return (size + unit - 1) // unit * unit
+
+
+def create_segment(name, size, hugepages='off', hugetlbfs_path=DEFAULT_HUGETLBFS_PATH):
+    """
+    创建（或复用已存在的）共享内存段
+    :param name: POSIX 共享内存名，如 '/shm_xxx'
+    :param hugepages: 'off' 普通页；'madvise' 普通 shm + MADV_HUGEPAGE（透明大页）；'hugetlbfs' 从 hugetlbfs 分配
+    :return: (seg_name, fd, map_size)，fd 由调用方关闭
+    """
+    if hugepages == 'hugetlbfs':
+        seg_name = os.path.join(hugetlbfs_path, name.lstrip('/'))
+        try:
+            map_size = _round_up(max(size, 1), _huge_page_size(hugetlbfs_path))
+            fd = os.open(seg_name, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            logger.warning(f"hugetlbfs unavailable at {hugetlbfs_path} ({e}), falling back to regular pages")
+        else:
+            try:
+                if os.fstat(fd).st_size < map_size:
+                    os.ftruncate(fd, map_size)
+                # 扩展 hugetlbfs 文件总会成功，大页在 mmap 时才预留，大页池不足（如 nr_hugepages=0）时在这里失败
+                mmap.mmap(fd, map_size, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ | mmap.PROT_WRITE).close()
+                return seg_name, fd, map_size
+            except OSError as e:
+                # 大页池不足
+                os.close(fd)
+                os.unlink(seg_name)
+                logger.warning(f"not enough huge pages for {seg_name} ({e}), falling back to regular pages")
+
+    map_size = max(size, 1)
+    try:
+        shm = posix_ipc.SharedMemory(
+            name=name,
+            flags=posix_ipc.O_CREAT | posix_ipc.O_EXCL,
+            mode=0o600,
+            size=map_size
+        )
+    except posix_ipc.ExistentialError:
+        shm = posix_ipc.SharedMemory(name=name)
+        if shm.size < map_size:
+            os.ftruncate(shm.fd, map_size)
+    fd = os.dup(shm.fd)
+    shm.close_fd()
+    return name, fd, map_size
+
+
+def open_segment(seg_name):
+    """以只读方式打开段，返回 (fd, size)，fd 由调用方关闭"""
+    if is_hugetlbfs_segment(seg_name):
+        fd = os.open(seg_name, os.O_RDONLY)
+    else:
+        shm = posix_ipc.SharedMemory(name=seg_name, flags=0, read_only=True)
+        fd = os.dup(shm.fd)
+        shm.close_fd()
+    return fd, os.fstat(fd).st_size
+
+
+def unlink_segment(seg_name):
+    """删除段；已有的映射在解除映射前仍然有效"""
+    if is_hugetlbfs_segment(seg_name):
+        os.unlink(seg_name)
+    else:
+        posix_ipc.unlink_shared_memory(seg_name)
+
+
+def map_segment(fd, size, write=False, populate=False, advice=None, hugepages='off'):
+    """
+    映射段
+    :param populate: MAP_POPULATE 预先建立页表，避免扫描时大量缺页
+    :param advice: 读取模式提示，'sequential' / 'random' / 'willneed' / 'normal'
+    :param hugepages: 为 'madvise' 时对映射加 MADV_HUGEPAGE
+    """
+    prot = mmap.PROT_READ | (mmap.PROT_WRITE if write else 0)
+    flags = mmap.MAP_SHARED | (MAP_POPULATE if populate else 0)
+    shm_mmap = mmap.mmap(fd, size, flags=flags, prot=prot)
+    if hugepages == 'madvise':
+        _madvise(shm_mmap, MADV_HUGEPAGE)
+    if advice is not None:
+        _madvise(shm_mmap, _ADVICE.get(advice))
+    return shm_mmap
+
+
+def _madvise(shm_mmap, advice):
+    if advice is None or not hasattr(shm_mmap, 'madvise'):
+        return
+    try:
+        shm_mmap.madvise(advice)
+    except OSError as e:
+        logger.debug(f"madvise({advice}) not supported: {e}")
+
+
+def _online_numa_nodes():
+    """解析 /sys/devices/system/node/online，例如 '0-1' -> [0, 1]"""
+    try:
+        with open('/sys/devices/system/node/online') as f:
+            spec = f.read().strip()
+    except OSError:
+        return [0]
+    nodes = []
+    for part in spec.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            nodes.extend(range(int(lo), int(hi) + 1))
+        elif part:
+            nodes.append(int(part))
+    return nodes
+
+
+def bind_numa(shm_mmap, size, numa):
+    """
+    在首次写入前设置段的 NUMA 内存策略（对 shm/hugetlbfs 为对象级共享策略）
+    :param numa: None 不设置；int 绑定到该节点；'interleave' 在所有在线节点间交错；list 在给定节点间交错
+    """
+    if numa is None:
+        return
+    if numa == 'interleave':
+        mode, nodes = MPOL_INTERLEAVE, _online_numa_nodes()
+    elif isinstance(numa, int):
+        mode, nodes = MPOL_BIND, [numa]
+    else:
+        mode, nodes = MPOL_INTERLEAVE, list(numa)
+
+    syscall_nr = _SYS_MBIND.get(platform.machine())
+    if syscall_nr is None or not nodes:
+        logger.warning(f"NUMA placement not supported on {platform.machine()}, ignored")
+        return
+
+    mask = 0
+    for node in nodes:
+        mask |= 1 << node
+    mask_words = _round_up(max(nodes) + 1, 64) // 64
+    nodemask = (ctypes.c_ulong * mask_words)(*[(mask >> (64 * i)) & (2**64 - 1) for i in range(mask_words)])
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    anchor = ctypes.c_char.from_buffer(shm_mmap)
+    try:
+        ret = libc.syscall(
+            ctypes.c_long(syscall_nr),
+            ctypes.c_void_p(ctypes.addressof(anchor)),
+            ctypes.c_ulong(size),
+            ctypes.c_int(mode),
+            nodemask,
+            ctypes.c_ulong(mask_words * 64 + 1),
+            ctypes.c_uint(0),
+        )
+    finally:
+        del anchor
+    if ret != 0:
+        logger.warning(f"mbind failed ({os.strerror(ctypes.get_errno())}), NUMA placement ignored")